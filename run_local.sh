@@ -1,28 +1 @@
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern singleton --prompt 0 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern singleton --prompt 0 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern singleton --prompt 1 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern singleton --prompt 1 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern adapter --prompt 0 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern adapter --prompt 0 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern adapter --prompt 1 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern adapter --prompt 1 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern composite --prompt 0 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern composite --prompt 0 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern composite --prompt 1 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern composite --prompt 1 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern bridge --prompt 0 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern bridge --prompt 0 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern bridge --prompt 1 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern bridge --prompt 1 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern decorator --prompt 0 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern decorator --prompt 0 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern decorator --prompt 1 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern decorator --prompt 1 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern facade --prompt 0 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern facade --prompt 0 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern facade --prompt 1 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern facade --prompt 1 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern proxy --prompt 0 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern proxy --prompt 0 --no-correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern proxy --prompt 1 --correct --no-half;
-python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern proxy --prompt 1 --no-correct --no-half;
+python3 -m src.api.LocalInference --model rjmalagon/Nxcode-CQ-7B-orpo-Q8_0-GGUF --pattern singleton adapter composite bridge decorator facade proxy --prompt 0 1 --no-half;
@@ -1,77 +1,99 @@
-from time import sleep
+from time import perf_counter
 import os
-import base64
+import random
+import asyncio
+import logging
+import httpx
+from .. import telemetry, run_ledger
+from ..cache import content_hash, open_response_cache, response_key
+from ..image_prep import IMAGE_MAX_SIDE, IMAGE_QUALITY, open_image_cache, prepare_image
+from ..rate_limit import RateLimiter
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
+CONCURRENCY = 2
+# Free tier of gemini-2.0-flash, raise it for paid keys
+REQUESTS_PER_MINUTE = 15
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 10.0
 
-def encode_image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
 
+def load_templates(prompt_path: str, questions_path: str = "questions.txt") -> tuple[str, str]:
+    """
+    Function to read the prompt template and the questions once for a whole run
 
-def run_model(model_name="gemini-2.0-flash", full=False, ignore=[], images=False):
-    # Any changes should only be made in the following lines
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-    content_path = (
-        "scenarios/Punctuality/variant-3asdf.txt" if not full else "scenarios/"
-    )
-    prompt_path = "text-prompt.txt" if not images else "image-prompt.txt"
-    # model_name = "gemini-2.0-flash"
-    output_path = "./final-outputs/" if not images else "./image-outputs-seedream-gend/"
+    OUTPUT:
+        - (prompt template, questions)
+    """
+    with open(prompt_path, "r") as fp:
+        prompt = fp.read()
+
+    with open(questions_path, "r") as fq:
+        questions = fq.read()
 
-    if os.path.isdir(content_path):
-        for scenario in os.listdir(content_path):
-            # print(scenario)
-            if len(ignore) != 0:
-                if scenario in ignore:
-                    continue
-            scenario_path = os.path.join(content_path, scenario)
-            if not images:
-                variants = [
-                    var
-                    for var in os.listdir(scenario_path)
-                    if os.path.isfile(os.path.join(scenario_path, var))
-                ]
-                for variant in variants:
-                    formatted_content_path = os.path.join(scenario_path, variant)
-                    get_response(
-                        client,
-                        formatted_content_path,
-                        output_path,
-                        model_name,
-                        prompt_path,
-                        images,
-                    )
-                    print(f"Generated response for {scenario}-{variant}...")
-                    sleep(60)
-
-            else:
-                images_path = os.path.join(scenario_path, "images")
-                variants = [
-                    var
-                    for var in os.listdir(images_path)
-                    if os.path.isfile(os.path.join(images_path, var)) and "-tr" in var
-                ]
-                for variant in variants:
-                    formatted_images_path = os.path.join(images_path, variant)
-                    print(f"waiting for response to output for {formatted_images_path}")
-                    get_response(
-                        client,
-                        formatted_images_path,
-                        output_path,
-                        model_name,
-                        prompt_path,
-                        images,
-                    )
-                    print(f"Generated response for {scenario}-{variant}...")
-                    sleep(60)
+    return prompt, questions
+
+
+def list_content_paths(content_path: str, ignore: list[str], images: bool) -> list[str]:
+    """
+    Function to list the scenario variants to send (the "-tr" images of every scenario in image mode)
+
+    INPUT:
+        - content_path -> A single variant file, or the scenarios directory
+        - ignore -> Scenarios to leave out
+        - images -> Whether to send the scenario images instead of the text variants
+    """
+    if not os.path.isdir(content_path):
+        return [content_path]
+
+    content_paths = []
+    for scenario in os.listdir(content_path):
+        if scenario in ignore:
+            continue
+        scenario_path = os.path.join(content_path, scenario)
+        if not images:
+            content_paths += [
+                os.path.join(scenario_path, var)
+                for var in os.listdir(scenario_path)
+                if os.path.isfile(os.path.join(scenario_path, var))
+            ]
+        else:
+            images_path = os.path.join(scenario_path, "images")
+            content_paths += [
+                os.path.join(images_path, var)
+                for var in os.listdir(images_path)
+                if os.path.isfile(os.path.join(images_path, var)) and "-tr" in var
+            ]
+    return content_paths
 
-    else:
-        get_response(client, content_path, output_path, model_name, prompt_path, images)
 
+def prepare_request(
+    content_path: str,
+    output_path: str,
+    model_name: str,
+    prompt_path: str,
+    prompt: str,
+    questions: str,
+    images: bool,
+    completed_prompts: set[str],
+    image_cache=None,
+    max_side: int = IMAGE_MAX_SIDE,
+    quality: int = IMAGE_QUALITY,
+) -> dict | None:
+    """
+    Function to read a scenario variant and build its request
 
-def get_response(client, content_path, output_path, model_name, prompt_path, images):
+    INPUT:
+        - content_path -> Text variant or image to send
+        - output_path -> Root of the outputs
+        - prompt_path, prompt, questions -> Prompt template (path and text) and questions
+        - completed_prompts -> Prompt hashes already in the ledger
+        - image_cache, max_side, quality -> Preparation of images, see image_prep.prepare_image
+
+    OUTPUT:
+        - request dict ("content_path", "output_file_path", "prompt_hash", "request_content", "cache_key",
+          "image_stats"), None when the variant was already answered
+    """
     formatted_output_path = os.path.join(
         output_path,
         model_name,
@@ -82,38 +104,326 @@ def get_response(client, content_path, output_path, model_name, prompt_path, ima
         ),
         os.path.splitext(os.path.basename(content_path))[0],
     )
+    output_file_path = formatted_output_path + ".txt"
 
     content_type = os.path.splitext(os.path.basename(content_path))[1]
 
-    if not os.path.exists(os.path.dirname(formatted_output_path)):
-        os.makedirs(os.path.dirname(formatted_output_path))
-
-    with open(prompt_path, "r") as fp:
-        prompt = fp.read()
+    with open(content_path, "rb") as fc:
+        content = fc.read()
 
-    with open("questions.txt", "r") as fq:
-        questions = fq.read()
+    # Already answered (the ledger only lists outputs written completely)
+    prompt_hash = run_ledger.prompt_key(output_file_path, prompt, questions, content)
+    if prompt_hash in completed_prompts:
+        print(f"{content_path} already answered.... Skipping")
+        return None
 
     if not images:
-        with open(content_path, "r") as fs:
-            content = fs.read()
-        formatted_prompt = prompt.format(content=content, questions=questions)
+        formatted_prompt = prompt.format(
+            content=content.decode("utf-8"), questions=questions
+        )
         request_content = formatted_prompt
     else:
-        with open(content_path, "rb") as fi:
-            content = fi.read()
         formatted_prompt = prompt.format(questions=questions)
+        prepared_image = prepare_image(
+            content,
+            f"image/{content_type[1:]}",
+            image_cache,
+            max_side,
+            quality,
+        )
+        content = prepared_image.pop("data")
         request_content = [
             types.Part.from_bytes(
                 data=content,
-                mime_type=f"image/{content_type[1:]}",
+                mime_type=prepared_image["mime_type"],
             ),
             formatted_prompt,
         ]
+        print(
+            f"{content_path}: {prepared_image['image_bytes'] / 1024:.0f} KiB -> "
+            f"{prepared_image['upload_bytes'] / 1024:.0f} KiB in {prepared_image['prep_s']:.3f}s"
+            f"{' (cached)' if prepared_image['cache_hit'] else ''}"
+        )
 
-    response = client.models.generate_content(
-        model=model_name, contents=request_content
+    # Identical request (model, prompt, uploaded bytes) answered before: the response is reused
+    cache_key = response_key(
+        "gemini",
+        model_name,
+        formatted_prompt if not images else [content_hash(content), formatted_prompt],
+        {"images": images},
     )
 
-    with open(formatted_output_path + ".txt", "w") as fo:
-        fo.write(str(response.text))
+    return {
+        "content_path": content_path,
+        "output_file_path": output_file_path,
+        "prompt_hash": prompt_hash,
+        "request_content": request_content,
+        "cache_key": cache_key,
+        "image_stats": (
+            {
+                "image_bytes": prepared_image["image_bytes"],
+                "upload_bytes": prepared_image["upload_bytes"],
+                "image_prep_s": prepared_image["prep_s"],
+                "image_cache_hit": prepared_image["cache_hit"],
+            }
+            if images
+            else {}
+        ),
+    }
+
+
+def ledger_params_for(prompt_path: str, images: bool) -> dict:
+    """
+    Function to build the ledger parameters of a Gemini run
+    """
+    return {"mode": "images" if images else "text", "prompt": prompt_path}
+
+
+def store_response(
+    ledger, model_name: str, request: dict, response_text: str, ledger_params: dict
+) -> None:
+    """
+    Function to write a response and add it to the ledger
+    """
+    run_ledger.write_output_atomic(request["output_file_path"], response_text)
+    run_ledger.record_completion(
+        ledger,
+        "gemini",
+        model_name,
+        request["prompt_hash"],
+        ledger_params,
+        request["output_file_path"],
+    )
+
+
+def record_response(model_name: str, request: dict, images: bool, response, latency: float) -> None:
+    """
+    Function to record the telemetry of an answered request
+    """
+    usage = response.usage_metadata
+    telemetry.record(
+        "gemini",
+        model_name,
+        content=request["content_path"],
+        images=images,
+        prompt_tokens=usage.prompt_token_count if usage else None,
+        completion_tokens=usage.candidates_token_count if usage else None,
+        latency_s=round(latency, 3),
+        **request["image_stats"],
+    )
+
+
+async def generate_async(
+    client, model_name: str, request: dict, images: bool, limiter: RateLimiter, logger
+) -> str | None:
+    """
+    Function to send one request through the async client within the RPM budget,
+    retrying rate limited (429), server (5xx), network and timeout errors with exponential backoff
+
+    OUTPUT:
+        - response text, None when every attempt failed
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        await asyncio.sleep(limiter.reserve())
+        start_time = perf_counter()
+        try:
+            response = await client.aio.models.generate_content(
+                model=model_name, contents=request["request_content"]
+            )
+        except errors.APIError as e:
+            if e.code != 429 and (e.code or 0) < 500:
+                logger.error(f"{request['content_path']}: {e}")
+                return None
+            backoff = BACKOFF_SECONDS * 2**attempt + random.uniform(0, 1)
+            if e.code == 429:
+                # Every request waits, not only this one
+                limiter.pause(backoff)
+            logger.warning(f"HTTP {e.code} for {request['content_path']}, retrying in {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+            continue
+        except (httpx.TransportError, asyncio.TimeoutError, ConnectionError) as e:
+            backoff = BACKOFF_SECONDS * 2**attempt + random.uniform(0, 1)
+            logger.warning(
+                f"{type(e).__name__} for {request['content_path']}: {e}, retrying in {backoff:.1f}s"
+            )
+            await asyncio.sleep(backoff)
+            continue
+        record_response(model_name, request, images, response, perf_counter() - start_time)
+        return str(response.text)
+
+    logger.error(f"{request['content_path']}: giving up after {MAX_RETRIES + 1} attempts")
+    return None
+
+
+async def run_pipeline(
+    client,
+    content_paths: list[str],
+    output_path: str,
+    model_name: str,
+    prompt_path: str,
+    images: bool,
+    concurrency: int = CONCURRENCY,
+    requests_per_minute: float = REQUESTS_PER_MINUTE,
+    max_side: int = IMAGE_MAX_SIDE,
+    quality: int = IMAGE_QUALITY,
+) -> int:
+    """
+    Function to answer scenario variants with up to `concurrency` requests in flight.
+
+    The templates are read once. While requests are in flight the next variant is read and its request built
+    in a worker thread, so it is ready as soon as a slot frees up. Requests are paced by the RPM budget;
+    outputs and the ledger are written from the event loop as responses arrive.
+
+    INPUT:
+        - client -> genai.Client (anything exposing client.aio.models.generate_content)
+        - content_paths -> Variants to send, see list_content_paths
+        - concurrency -> Requests in flight
+        - requests_per_minute -> RPM budget of the model
+        - max_side, quality -> Budget of the uploaded images, see image_prep.prepare_image
+
+    OUTPUT:
+        - number of responses written
+    """
+    logger = logging.getLogger(__name__)
+    prompt, questions = load_templates(prompt_path)
+    ledger = run_ledger.open_ledger()
+    ledger_params = ledger_params_for(prompt_path, images)
+    completed_prompts = run_ledger.completed_prompts(
+        ledger, "gemini", model_name, ledger_params
+    )
+    response_cache = open_response_cache()
+    image_cache = open_image_cache() if images else None
+    limiter = RateLimiter(requests_per_minute)
+    window = asyncio.Semaphore(concurrency)
+    written = 0
+    image_bytes = upload_bytes = 0
+
+    async def answer(request: dict) -> None:
+        # Failures are logged here, so one request never takes the others down
+        nonlocal written
+        try:
+            response_text = await generate_async(
+                client, model_name, request, images, limiter, logger
+            )
+            if response_text is None:
+                return
+            response_cache.set(request["cache_key"], response_text)
+            store_response(ledger, model_name, request, response_text, ledger_params)
+            written += 1
+            print(f"Generated response for {request['content_path']}...")
+        except Exception as e:
+            logger.error(f"{request['content_path']}: {e}", exc_info=True)
+        finally:
+            window.release()
+
+    def prepare(content_path: str):
+        return asyncio.create_task(
+            asyncio.to_thread(
+                prepare_request,
+                content_path,
+                output_path,
+                model_name,
+                prompt_path,
+                prompt,
+                questions,
+                images,
+                completed_prompts,
+                image_cache,
+                max_side,
+                quality,
+            )
+        )
+
+    in_flight = set()
+    next_request = prepare(content_paths[0]) if content_paths else None
+    try:
+        for i in range(len(content_paths)):
+            try:
+                request = await next_request
+            except (OSError, UnicodeDecodeError) as e:
+                logger.error(f"{content_paths[i]}: {e}")
+                request = None
+            # Read the following variant while this one waits for a slot
+            next_request = prepare(content_paths[i + 1]) if i + 1 < len(content_paths) else None
+            if request is None:
+                continue
+            image_bytes += request["image_stats"].get("image_bytes", 0)
+            upload_bytes += request["image_stats"].get("upload_bytes", 0)
+
+            response_text = response_cache.get(request["cache_key"])
+            if response_text is not None:
+                telemetry.record(
+                    "gemini",
+                    model_name,
+                    content=request["content_path"],
+                    images=images,
+                    cache_hit=True,
+                    **request["image_stats"],
+                )
+                store_response(ledger, model_name, request, response_text, ledger_params)
+                written += 1
+                continue
+
+            await window.acquire()
+            task = asyncio.create_task(answer(request))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        await asyncio.gather(*in_flight)
+    finally:
+        # Also reached when the run is interrupted: requests still pending are dropped
+        for task in in_flight:
+            task.cancel()
+        if next_request is not None:
+            next_request.cancel()
+        response_cache.close()
+        if image_cache is not None:
+            image_cache.close()
+        ledger.close()
+    if images:
+        print(
+            f"Images: {image_bytes / 1024**2:.1f} MiB stored, {upload_bytes / 1024**2:.1f} MiB uploaded "
+            f"({(image_bytes - upload_bytes) / 1024**2:.1f} MiB saved)"
+        )
+    return written
+
+
+def run_model(
+    model_name="gemini-2.0-flash",
+    full=False,
+    ignore=[],
+    images=False,
+    concurrency=CONCURRENCY,
+    requests_per_minute=REQUESTS_PER_MINUTE,
+    client=None,
+    max_side=IMAGE_MAX_SIDE,
+    quality=IMAGE_QUALITY,
+):
+    # Any changes should only be made in the following lines
+    client = (
+        client
+        if client is not None
+        else genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+    )
+    content_path = (
+        "scenarios/Punctuality/variant-3asdf.txt" if not full else "scenarios/"
+    )
+    prompt_path = "text-prompt.txt" if not images else "image-prompt.txt"
+    # model_name = "gemini-2.0-flash"
+    output_path = "./final-outputs/" if not images else "./image-outputs-seedream-gend/"
+
+    written = asyncio.run(
+        run_pipeline(
+            client,
+            list_content_paths(content_path, ignore, images),
+            output_path,
+            model_name,
+            prompt_path,
+            images,
+            concurrency,
+            requests_per_minute,
+            max_side,
+            quality,
+        )
+    )
+    print(f"{written} responses written to {output_path}")
@@ -1,50 +1,434 @@
 import os
 import sys
+import codecs
+import contextlib
+import queue
+import multiprocessing
 import logging
-from .. import utils
-from datetime import datetime
+import resource
+import psutil
+import llama_cpp
+import numpy as np
+from .. import utils, token_budget
+from ..throttle import Throttle, throttle_from_env
+from ..verdict import (
+    VERDICT_GRAMMAR,
+    VERDICT_MAX_TOKENS,
+    VERDICT_VARIANTS,
+    calibrated_confidence,
+    fit_platt_scaling,
+    is_calibration_prompt,
+    load_calibration,
+    save_calibration,
+)
+from .. import telemetry, run_ledger
+from ..batch_decoding import BatchedContext, generate_batched
+from ..cache import CACHE_DIR, content_hash, open_response_cache, response_key
 from llama_cpp import (
     Llama,
+    LlamaDiskCache,
+    LlamaGrammar,
+    LlamaPromptLookupDecoding,
+    LlamaRAMCache,
     LLAMA_ROPE_SCALING_TYPE_LINEAR,
     LLAMA_ROPE_SCALING_TYPE_YARN,
 )
-from time import sleep
+from llama_cpp.llama_cache import BaseLlamaCache
+from llama_cpp._internals import LlamaContext
+from time import perf_counter
 import argparse
+import pandas as pd
 from pathlib import Path
+from typing import Callable
 
 
-def process_in_chunks(
-    llm: Llama, long_text: str, chunk_size: int = 1500, max_tokens: int = 1024
-):
-    """Process long text into chunks"""
+# Sampling seed of every local completion, so a cached answer is the one a rerun would produce
+SEED = 42
+CODE_MARKER = "CODE:\n"
+CHUNK_NOTES_PROMPT = """You are reading a long {type} code in parts. After the last part you will be asked:
+
+{question}
+
+Notes on the earlier parts:
+{notes}
+
+PART {part} OF {parts}:
+{chunk}
+
+Rewrite the notes so they keep every detail of the code read so far that matters for that question (class declarations, fields, constructors, method signatures, calls to other classes). Do not answer the question yet."""
+CHUNK_FINAL_PROMPT = """{instructions}Notes on parts 1 to {notes_parts} of the code:
+{notes}
+
+PART {part} OF {parts}:
+{chunk}"""
+
+
+def split_on_tokens(llm: Llama, text: str, chunk_tokens: int) -> list[str]:
+    """
+    Function to split a text into pieces of at most chunk_tokens tokens, cut on token boundaries
+    (characters spanning two pieces are kept whole in the first one)
+    """
+    tokens = llm.tokenize(text.encode("utf-8"), add_bos=False, special=False)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
     chunks = [
-        str(long_text[i : i + chunk_size]) for i in range(0, len(long_text), chunk_size)
+        decoder.decode(llm.detokenize(tokens[start : start + chunk_tokens]))
+        for start in range(0, len(tokens), chunk_tokens)
     ]
+    if not chunks:
+        return [""]
+    chunks[-1] += decoder.decode(b"", final=True)
+    return chunks
 
-    results = []
-    context = ""
 
-    for i, chunk in enumerate(chunks):
-        chunked_prompt = f"""Context from previous: {context}
+def process_in_chunks(
+    llm: Llama,
+    instructions: str,
+    code: str,
+    code_type: str,
+    max_tokens: int = 1200,
+    summary_tokens: int = 384,
+    chunk_tokens: int | None = None,
+    grammar: LlamaGrammar | None = None,
+) -> str:
+    """
+    Function to answer a prompt whose code does not fit in the context, one token-bounded chunk at a time.
+
+    Every chunk but the last updates a rolling set of notes (capped at summary_tokens tokens), the last
+    chunk is sent with the original instructions and the notes to produce the final verdict.
+
+    INPUTS: llm = Llama (loaded model)
+            instructions = string (prompt text before the code, "CODE:" header included)
+            code = string (code to be split)
+            code_type = string ("java" or "uml")
+            max_tokens = int (tokens for the final answer)
+            summary_tokens = int (bound on the rolling notes)
+            chunk_tokens = int (code tokens per chunk, the most that fits in the context when None)
+            grammar = LlamaGrammar (constrains the final answer only)
+
+    OUTPUTS: final answer (str)
+    """
+
+    def complete(
+        prompt: str, answer_tokens: int, grammar: LlamaGrammar | None = None
+    ) -> str:
+        output = llm.create_chat_completion(
+            messages=[
+                {"role": "system", "content": utils.SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.6,
+            max_tokens=answer_tokens,
+            top_p=0.95,
+            seed=SEED,
+            stream=False,
+            grammar=grammar,
+        )
+        assert isinstance(output, dict)
+        return output["choices"][0]["message"]["content"].strip()
+
+    question = instructions.removesuffix(CODE_MARKER).strip()
+    if chunk_tokens is None:
+        template_tokens = max(
+            len(
+                llm.tokenize(
+                    token_budget.format_chat_prompt(template).encode("utf-8"),
+                    add_bos=True,
+                    special=True,
+                )
+            )
+            for template in (
+                CHUNK_NOTES_PROMPT.format(
+                    type=code_type, question=question, notes="", part=0, parts=0, chunk=""
+                ),
+                CHUNK_FINAL_PROMPT.format(
+                    instructions=instructions, notes_parts=0, notes="", part=0, parts=0, chunk=""
+                ),
+            )
+        )
+        chunk_tokens = (
+            llm.n_ctx()
+            - template_tokens
+            - summary_tokens
+            - max(max_tokens, summary_tokens)
+            - 16
+        )
+    assert chunk_tokens > 0, f"Context of {llm.n_ctx()} tokens too small to chunk"
+
+    chunks = split_on_tokens(llm, code, chunk_tokens)
+    notes = "None yet."
+    for part, chunk in enumerate(chunks[:-1], start=1):
+        print(f"Chunk {part}/{len(chunks)}: updating notes...")
+        notes = complete(
+            CHUNK_NOTES_PROMPT.format(
+                type=code_type,
+                question=question,
+                notes=notes,
+                part=part,
+                parts=len(chunks),
+                chunk=chunk,
+            ),
+            summary_tokens,
+        )
+
+    print(f"Chunk {len(chunks)}/{len(chunks)}: final verdict...")
+    if len(chunks) == 1:
+        return complete(instructions + chunks[0], max_tokens, grammar)
+    return complete(
+        CHUNK_FINAL_PROMPT.format(
+            instructions=instructions,
+            notes_parts=len(chunks) - 1,
+            notes=notes,
+            part=len(chunks),
+            parts=len(chunks),
+            chunk=chunks[-1],
+        ),
+        max_tokens,
+        grammar,
+    )
+
+
+PREFIX_CACHE_BYTES = 2 << 30
+PREFIX_SENTINEL = "\x00PREFIX-END\x00"
+
+
+def open_prefix_cache(model_id: str, n_ctx: int, kind: str) -> BaseLlamaCache | None:
+    """
+    Function to open the store of evaluated prompt prefixes (kind = "off", "ram" or "disk").
+    Disk caches are kept per model and context size so they survive between runs.
+    """
+    if kind == "ram":
+        return LlamaRAMCache(capacity_bytes=PREFIX_CACHE_BYTES)
+    if kind == "disk":
+        return LlamaDiskCache(
+            cache_dir=os.path.join(
+                CACHE_DIR, "llama-prefix", content_hash(model_id, str(n_ctx))[:16]
+            )
+        )
+    assert kind == "off", f"Unknown prefix cache {kind}"
+    return None
+
+
+def shared_prompt_prefix(model: Llama, pattern: str, role: str, prompt_type: int) -> list[int]:
+    """
+    Function to tokenize the part of the chat prompt shared by every prompt of a role
+    (system message and the instructions of prompt.txt up to the code)
+    """
+    with open("prompt.txt", "r") as base_prompt_file:
+        base_prompt = base_prompt_file.read()
+    instructions = base_prompt[: base_prompt.index("{code}")].format(
+        role=role, pattern=pattern, type="java" if prompt_type == 0 else "uml"
+    )
+    chat_prompt = token_budget.format_chat_prompt(instructions + PREFIX_SENTINEL)
+    return model.tokenize(
+        chat_prompt[: chat_prompt.index(PREFIX_SENTINEL)].encode("utf-8"),
+        add_bos=True,
+        special=True,
+    )
+
+
+def warm_prefix_cache(model: Llama, prefix_cache: BaseLlamaCache, prefix_tokens: list[int]) -> None:
+    """
+    Function to evaluate a shared prefix once and store the resulting model state
+    """
+    try:
+        cached_state = prefix_cache[prefix_tokens]
+        if (
+            Llama.longest_token_prefix(cached_state.input_ids.tolist(), prefix_tokens)
+            == len(prefix_tokens)
+        ):
+            return
+    except KeyError:
+        pass
+
+    start_time = perf_counter()
+    model.reset()
+    model.eval(prefix_tokens)
+    prefix_cache[prefix_tokens] = model.save_state()
+    print(
+        f"Prefix of {len(prefix_tokens)} tokens evaluated and cached in "
+        f"{perf_counter() - start_time:.2f}s"
+    )
+
+
+def restore_prefix(model: Llama, prefix_cache: BaseLlamaCache, prompt: str) -> tuple[int, int]:
+    """
+    Function to resume a prompt from the longest evaluated prefix (current context or cache)
+
+    OUTPUT:
+        - (prompt tokens already evaluated, total prompt tokens)
+    """
+    prompt_tokens = model.tokenize(
+        token_budget.format_chat_prompt(prompt).encode("utf-8"),
+        add_bos=True,
+        special=True,
+    )
+    reused_tokens = Llama.longest_token_prefix(
+        model._input_ids.tolist(), prompt_tokens
+    )
+    try:
+        cached_state = prefix_cache[prompt_tokens]
+        cached_tokens = Llama.longest_token_prefix(
+            cached_state.input_ids.tolist(), prompt_tokens
+        )
+        if cached_tokens > reused_tokens:
+            model.load_state(cached_state)
+            reused_tokens = cached_tokens
+    except KeyError:
+        pass
+    return reused_tokens, len(prompt_tokens)
+
+
+def read_perf_counters(model: Llama) -> dict[str, float | None]:
+    """
+    Function to read llama.cpp's prefill/decode timings since the last llama_perf_context_reset
+    (time to first token is the prefill plus one decode step).
+
+    Prompt and completion token counts come from the completion's usage instead: with prompt lookup
+    decoding n_eval only counts single-token steps and every multi-token verification batch lands in the
+    prefill counters, so the prefill/decode split is only reported when no draft model is loaded.
+    """
+    if model.draft_model is not None:
+        return {"prefill_tokens": None, "prefill_s": None, "decode_s": None, "ttft_s": None}
+    perf = llama_cpp.llama_perf_context(model._ctx.ctx)
+    decode_step_ms = perf.t_eval_ms / perf.n_eval if perf.n_eval else 0.0
+    return {
+        "prefill_tokens": perf.n_p_eval,
+        "prefill_s": round(perf.t_p_eval_ms / 1000, 3),
+        "decode_s": round(perf.t_eval_ms / 1000, 3),
+        "ttft_s": round((perf.t_p_eval_ms + decode_step_ms) / 1000, 3),
+    }
+
+
+def load_model(
+    model_id: str,
+    half_power: bool,
+    n_ctx: int,
+    draft_tokens: int = 0,
+    n_threads: int | None = None,
+) -> Llama:
+    """
+    Function to load a local GGUF model with the thread and context settings used for inference
+    (draft_tokens > 0 enables prompt lookup speculative decoding with that many predicted tokens,
+    n_threads pins the thread count instead of deriving it from the machine and half_power)
+
+    Speculative decoding needs the logits of every position, so with draft_tokens > 0 the scores buffer
+    holds n_ctx x vocabulary floats (n_ctx x n_vocab x 4 bytes, e.g. about 4.6 GB for 8192 tokens of a
+    152k vocabulary) instead of one batch worth.
+    """
+    if n_threads is None:
+        n_threads = os.cpu_count()
+        assert n_threads is not None, "Error Received... Can't find threads"
+        n_threads_half = n_threads // 2
+        if half_power:
+            print(f"\n{"="*60}\n")
+            print("Running Half Efficiency")
+            print(f"\n{"="*60}\n")
+            n_threads = n_threads // 2
+        else:
+            n_threads = n_threads - 2
+        n_threads_generate = n_threads - 2 if not half_power else n_threads_half
+    else:
+        n_threads_generate = n_threads
+    return Llama(
+        model_path=utils.get_model_path(model_id),
+        chat_format="chatml",
+        # Parameters tuning
+        n_ctx=n_ctx,
+        n_threads=n_threads_generate,
+        n_threads_batch=n_threads,
+        n_batch=512,
+        n_ubatch=2048,
+        # rope_scaling_type=LLAMA_ROPE_SCALING_TYPE_LINEAR,
+        # rope_freq_base=10000,
+        use_mlock=True,
+        use_mmap=True,
+        seed=SEED,
+        verbose=False,
+        # Sizes scores for every position, the draft model verifies tokens past the first batch
+        logits_all=draft_tokens > 0,
+        draft_model=(
+            LlamaPromptLookupDecoding(num_pred_tokens=draft_tokens)
+            if draft_tokens > 0
+            else None
+        ),
+    )
+
+
+def resize_context(model: Llama, n_ctx: int) -> None:
+    """
+    Function to give a loaded model a context of n_ctx tokens without reloading its weights:
+    only the llama.cpp context (KV cache) and the buffers sized from the context are rebuilt
+    """
+    previous_context = model._ctx
+    model.context_params.n_ctx = n_ctx
+    model._ctx = model._stack.enter_context(
+        contextlib.closing(
+            LlamaContext(model=model._model, params=model.context_params, verbose=model.verbose)
+        )
+    )
+    previous_context.close()
+    model._n_ctx = n_ctx
+    model.n_tokens = 0
+    model.input_ids = np.ndarray((n_ctx,), dtype=np.intc)
+    model.scores = np.ndarray(
+        (n_ctx if model._logits_all else model.n_batch, model.n_vocab()), dtype=np.single
+    )
 
-            Current chunk:
-            {chunk}
-            
-            Continue processing:
-        """
+
+def claimed_prompts(prompts: list, claim_prompt: Callable[[], int]):
+    """
+    Function to yield the prompts claimed through claim_prompt until every index has been handed out
+    (indices refer to the prompts sorted by role and filename, the same order in every worker)
+    """
+    prompts = sorted(prompts, key=lambda prompt_row: prompt_row[:2])
+    while (index := claim_prompt()) < len(prompts):
+        yield prompts[index]
 
 
 def run_model(
-    model_id: str, pattern: str, prompt_type: int, correct: bool, half_power: bool
-) -> None:
+    model_id: str,
+    pattern: str,
+    prompt_type: int,
+    correct: bool,
+    half_power: bool,
+    n_ctx: int | None = None,
+    n_ctx_max: int = 32768,
+    max_tokens: int = 1200,
+    dataset_path: str | None = None,
+    model: Llama | None = None,
+    prefix_cache: str | BaseLlamaCache | None = "off",
+    prompt_names: set[tuple[str, str]] | None = None,
+    throttle: Throttle | None = None,
+    chunk_long_prompts: bool = False,
+    draft_tokens: int = 0,
+    structured: bool = False,
+    parallel: int = 1,
+    batched_context: BatchedContext | None = None,
+    claim_prompt: Callable[[], int] | None = None,
+) -> list[float]:
     """
     Function to inference LLM in local machine and store results in appropriate files.
 
     INPUTS: model_name = string (which model to inference)
             pattern = string (which pattern to identify)
             correct = bool (whether to decipher for correct files or not)
+            n_ctx = int (context size, chosen from the prompt lengths when None)
+            n_ctx_max = int (largest context allowed, longer prompts are skipped)
+            max_tokens = int (tokens reserved for the answer)
+            dataset_path = string (packed prompt dataset, prompt directories when None)
+            model = Llama (already loaded model to reuse, its context size is kept)
+            prefix_cache = "off", "ram", "disk" or an opened cache (reuse the evaluated shared prompt prefix)
+            prompt_names = set of (role, prompt filename) to run (all prompts when None)
+            throttle = Throttle (pauses between prompts while the machine is hot)
+            chunk_long_prompts = bool (process prompts overflowing n_ctx in chunks instead of skipping them)
+            draft_tokens = int (prompt lookup decoding tokens when the model is loaded here, 0 = off)
+            structured = bool (force a YES/NO answer with a short explanation through a grammar)
+            parallel = int (prompts decoded together in one batched context, 1 = one at a time)
+            batched_context = BatchedContext (already created batched context to reuse, its parallel is kept)
+            claim_prompt = function returning the index of the next prompt to answer, shared by the
+                           workers running the same job (every prompt is answered when None)
 
-    OUTPUTS: None
+    OUTPUTS: list of per-prompt latencies in seconds
     """
 
     print(model_id, pattern, prompt_type, correct, half_power)
@@ -58,140 +442,1202 @@ def run_model(
     )
     logger = logging.getLogger(__name__)
 
-    local_model_logpath = "llama_cpp_verbose.log"
+    # A grammar forces the verdict first and bounds the explanation
+    grammar = None
+    if structured:
+        grammar = LlamaGrammar.from_string(VERDICT_GRAMMAR, verbose=False)
+        max_tokens = min(max_tokens, VERDICT_MAX_TOKENS)
 
-    # Calculate model path
-    model_snapshot_path = os.path.join(
-        "models",
-        "--".join(["models"] + model_id.split(os.path.sep)),
-        "snapshots",
+    prompts = utils.load_prompts(prompt_type, correct, pattern, dataset_path)
+    if prompt_names is not None:
+        prompts = [
+            prompt_row for prompt_row in prompts if prompt_row[:2] in prompt_names
+        ]
+
+    # Size the KV cache from the real prompt lengths instead of a fixed context
+    token_df = token_budget.analyze_prompt_set(
+        model_id,
+        prompt_type,
+        (pattern,),
+        (correct,),
+        tokenizer=model,
+        dataset_path=dataset_path,
     )
+    if model is not None:
+        n_ctx = model.n_ctx()
+    elif n_ctx is None:
+        n_ctx, _ = token_budget.choose_context_size(
+            token_df["Tokens"].tolist(), max_tokens, n_ctx_max
+        )
+        print(f"Context size chosen from prompt lengths: {n_ctx}")
+
+    overflowing_prompts = set()
+    for _, row in token_df[token_df["Tokens"] + max_tokens > n_ctx].iterrows():
+        overflowing_prompts.add((row["Role"], row["Prompt"]))
+        logger.warning(
+            f"{row['Role']}/{row['Prompt']} needs {row['Tokens'] + max_tokens} tokens, "
+            f"more than n_ctx={n_ctx}"
+        )
 
     # Load models
-    n_threads = os.cpu_count()
-    assert n_threads is not None, "Error Received... Can't find threads"
-    n_threads_half = n_threads // 2
-    if half_power:
-        print(f"\n{"="*60}\n")
-        print("Running Half Efficiency")
-        print(f"\n{"="*60}\n")
-        n_threads = n_threads // 2
-    else:
-        n_threads = n_threads - 2
-    model = Llama(
-        model_path=utils.find_file_in_subdir(model_snapshot_path),
-        chat_format="chatml",
-        # Parameters tuning
-        n_ctx=17000,
-        n_threads=n_threads - 2 if not half_power else n_threads_half,
-        n_threads_batch=n_threads,
-        n_batch=512,
-        n_ubatch=2048,
-        # rope_scaling_type=LLAMA_ROPE_SCALING_TYPE_LINEAR,
-        # rope_freq_base=10000,
-        use_mlock=True,
-        use_mmap=True,
-        verbose=True,
-    )
+    if model is None:
+        model = load_model(model_id, half_power, n_ctx, draft_tokens)
+
+    # Evaluate the shared instructions of every role once, prompts resume from there
+    if isinstance(prefix_cache, str):
+        prefix_cache = open_prefix_cache(model_id, n_ctx, prefix_cache)
+    if prefix_cache is not None:
+        for role in dict.fromkeys(role for role, _, _, _ in prompts):
+            warm_prefix_cache(
+                model,
+                prefix_cache,
+                shared_prompt_prefix(model, pattern, role, prompt_type),
+            )
+    saved_prefill_tokens = 0
+    own_throttle = throttle is None
+    if own_throttle:
+        throttle = throttle_from_env(fixed_sleep=30, logger=logger)
+    latencies = []
 
     # Declarations
-    common_prompt_path = ["prompts-code", "prompts-uml", "prompts-summary"][prompt_type]
-    pattern_prompt_path = os.path.join(
-        common_prompt_path, "correct" if correct else "incorrect", pattern
-    )
-    collected_prompts = utils.check_collected_prompts(model_id, correct, prompt_type)
-    print(collected_prompts)
-
-    # Iterate over all prompt files
-    for i, role in enumerate(os.listdir(pattern_prompt_path)):
-        print(i, role)
-        role_path = os.path.join(pattern_prompt_path, role)
-        for j, prompt in enumerate(
-            sorted(os.listdir(role_path), key=lambda x: int(x[:2].strip()))
-        ):
-            # Make prompt ready
-            current_prompt_file_path = os.path.join(role_path, prompt)
-            print(os.path.sep.join(current_prompt_file_path.split(os.path.sep)[2:]))
-            if (
-                os.path.sep.join(current_prompt_file_path.split(os.path.sep)[2:])
-            ) in collected_prompts:
-                print(f"Prompt {prompt} already used..... Skipping")
-                continue
-            with open(current_prompt_file_path, "r") as current_prompt_file:
-                current_prompt = current_prompt_file.read()
-
-            print(f"Loaded prompt {os.path.basename(current_prompt_file_path)}....")
-
-            print(f"Model inferenced...")
-
-            with open(local_model_logpath, "a") as log_file:
-                # Redirect stderr to the log_file
-                original_stderr = sys.stderr
-                sys.stderr = log_file
-
-                # Inference the local model and log output results
-                timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                log_file.write(f"\n{'='*60}\n")
-                log_file.write(f"[{timestamp}] Filename: {prompt}")
-                log_file.write(f"\n{'='*60}\n")
-                # log_file.flush()
-
-                output = model.create_chat_completion(
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "You are a senior software engineer experienced in object-oriented design patterns.",
-                        },
-                        {"role": "user", "content": current_prompt},
-                    ],
-                    temperature=0.6,
-                    max_tokens=1200,
-                    top_p=0.95,
-                    stream=False,
+    ledger = run_ledger.open_ledger()
+    ledger_params = {
+        "prompt_type": prompt_type,
+        "mode": "structured" if structured else "generate",
+    }
+    completed_prompts = run_ledger.completed_prompts(
+        ledger, "local", model_id, ledger_params
+    )
+    output_paths = {
+        (role, prompt): utils.get_output_path(
+            prompt_type,
+            model_id,
+            correct,
+            pattern,
+            role,
+            current_prompt_file_path,
+            ledger_params["mode"],
+        )
+        for role, prompt, current_prompt_file_path, _ in prompts
+    }
+    prompt_keys = {
+        (role, prompt): run_ledger.prompt_key(output_paths[(role, prompt)], current_prompt)
+        for role, prompt, _, current_prompt in prompts
+    }
+    # Outputs written before the ledger existed are not generated again
+    adopted_prompts = run_ledger.adopt_existing_outputs(
+        ledger,
+        "local",
+        model_id,
+        ledger_params,
+        {
+            prompt_keys[prompt_name]: output_path
+            for prompt_name, output_path in output_paths.items()
+            if prompt_keys[prompt_name] not in completed_prompts
+        },
+    )
+    if adopted_prompts:
+        print(f"{len(adopted_prompts)} existing outputs adopted into the run ledger")
+    completed_prompts |= adopted_prompts
+    print(f"{len(completed_prompts)} prompts already answered")
+
+    # Identical requests (model, messages, decoding parameters) are answered from the response cache
+    response_cache = open_response_cache()
+    response_keys = {
+        (role, prompt): response_key(
+            "local",
+            model_id,
+            [
+                {"role": "system", "content": utils.SYSTEM_PROMPT},
+                {"role": "user", "content": current_prompt},
+            ],
+            {
+                "temperature": 0.6,
+                "top_p": 0.95,
+                "seed": SEED,
+                "max_tokens": max_tokens,
+                "structured": structured,
+                "chunked": (role, prompt) in overflowing_prompts,
+            },
+        )
+        for role, prompt, _, current_prompt in prompts
+        if prompt_keys[(role, prompt)] not in completed_prompts
+    }
+    cached_responses = {
+        prompt_name: response_cache.get(key)
+        for prompt_name, key in response_keys.items()
+        if key in response_cache
+    }
+    print(f"{len(cached_responses)} answers found in the response cache")
+
+    def store_answer(
+        role: str,
+        prompt: str,
+        res: str,
+        latency: float,
+        perf: dict,
+        prompt_tokens: int | None,
+        completion_tokens: int | None,
+        reused_tokens: int | None = None,
+        chunked: bool = False,
+        cache_hit: bool = False,
+        batched: bool = False,
+    ) -> None:
+        """
+        Function to cache, record and write one answer, and add it to the ledger
+        """
+        latencies.append(latency)
+        if not cache_hit:
+            response_cache.set(response_keys[(role, prompt)], str(res))
+        if completion_tokens is not None:
+            print(
+                f"{completion_tokens} tokens in {latency:.2f}s "
+                f"({completion_tokens / max(latency, 1e-9):.1f} tokens/s)"
+            )
+        if reused_tokens is not None:
+            print(
+                f"Prefix cache: {reused_tokens}/{prompt_tokens} prompt tokens reused "
+                f"({saved_prefill_tokens} saved so far)"
+            )
+        telemetry.record(
+            "local",
+            model_id,
+            pattern=pattern,
+            prompt_type=prompt_type,
+            correct=correct,
+            role=role,
+            prompt=prompt,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            reused_prefix_tokens=reused_tokens,
+            latency_s=round(latency, 3),
+            prefill_s=perf["prefill_s"],
+            prefill_tokens=perf["prefill_tokens"],
+            decode_s=perf["decode_s"],
+            ttft_s=perf["ttft_s"],
+            chunked=chunked,
+            cache_hit=cache_hit,
+            params={
+                "n_ctx": model.n_ctx(),
+                "n_threads": model.n_threads,
+                "temperature": 0.6,
+                "top_p": 0.95,
+                "max_tokens": max_tokens,
+                "draft": model.draft_model is not None,
+                "structured": structured,
+                "parallel": parallel if batched else 1,
+            },
+        )
+
+        output_file_path = output_paths[(role, prompt)]
+
+        print(f"Response received.... Writing to {output_file_path}")
+
+        try:
+            run_ledger.write_output_atomic(output_file_path, str(res))
+            run_ledger.record_completion(
+                ledger,
+                "local",
+                model_id,
+                prompt_keys[(role, prompt)],
+                ledger_params,
+                output_file_path,
+            )
+            print("Output sorted....")
+
+        except FileExistsError as e:
+            logger.error(f"Error occurred: {e}")
+            print("Error message received and logged... Aborting")
+            sys.exit(1)
+
+        except FileNotFoundError as e:
+            logger.error(f"Error occurred: {e}")
+            print("Error message received and logged... Aborting")
+            sys.exit(2)
+
+    # Answer every prompt that fits up front, `parallel` sequences at a time,
+    # storing each answer as soon as its sequence finishes
+    batched_prompts = set()
+    if batched_context is not None:
+        parallel = batched_context.parallel
+    if parallel > 1 and grammar is None:
+        own_batched_context = batched_context is None
+        if own_batched_context:
+            batched_context = BatchedContext(model, parallel, n_ctx)
+        batch_prompts = [
+            (role, prompt, current_prompt)
+            for role, prompt, _, current_prompt in prompts
+            if (role, prompt) in response_keys
+            and (role, prompt) not in cached_responses
+            and (role, prompt) not in overflowing_prompts
+        ]
+        start_time = perf_counter()
+        generated_tokens = 0
+        try:
+            for index, result in generate_batched(
+                batched_context,
+                [current_prompt for *_, current_prompt in batch_prompts],
+                max_tokens=max_tokens,
+                seed=SEED,
+            ):
+                role, prompt, _ = batch_prompts[index]
+                if result["error"] is not None:
+                    logger.warning(f"{role}/{prompt} not batched: {result['error']}")
+                    continue
+                store_answer(
+                    role,
+                    prompt,
+                    result["text"],
+                    result["latency_s"],
+                    {"prefill_tokens": None, "prefill_s": None, "decode_s": None, "ttft_s": None},
+                    result["prompt_tokens"],
+                    result["completion_tokens"],
+                    batched=True,
                 )
+                batched_prompts.add((role, prompt))
+                generated_tokens += result["completion_tokens"]
+        finally:
+            if own_batched_context:
+                batched_context.close()
+        elapsed = perf_counter() - start_time
+        print(
+            f"Batched {len(batched_prompts)} prompts x{parallel}: {generated_tokens} tokens in "
+            f"{elapsed:.1f}s ({generated_tokens / max(elapsed, 1e-9):.1f} tokens/s aggregate)"
+        )
+        throttle.wait()
+    elif parallel > 1:
+        print("Batched decoding does not support grammars, running one prompt at a time")
+
+    # Iterate over all prompt files (only the ones this worker claims when the job is shared)
+    for role, prompt, current_prompt_file_path, current_prompt in (
+        prompts if claim_prompt is None else claimed_prompts(prompts, claim_prompt)
+    ):
+        # Make prompt ready
+        if prompt_keys[(role, prompt)] in completed_prompts:
+            print(f"Prompt {prompt} already used..... Skipping")
+            continue
+        if (role, prompt) in batched_prompts:
+            continue
+        chunked = (role, prompt) in overflowing_prompts
+        instructions, code_marker, code = current_prompt.partition(CODE_MARKER)
+        if chunked and not (chunk_long_prompts and code_marker):
+            print(f"Prompt {prompt} does not fit in the context..... Skipping")
+            continue
+        print(f"Loaded prompt {os.path.basename(current_prompt_file_path)}....")
 
-                timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                log_file.write(f"\n{'='*60}\n")
-                log_file.write(f"[{timestamp}] Output Received")
-                log_file.write(f"\n{'='*60}\n")
+        print(f"Model inferenced...")
 
-                # Restore stderror
-                sys.stderr = original_stderr
+        cached_response = cached_responses.get((role, prompt))
+        reused_tokens = None
+        if prefix_cache is not None and not chunked and cached_response is None:
+            reused_tokens, _ = restore_prefix(model, prefix_cache, current_prompt)
+            saved_prefill_tokens += reused_tokens
+        llama_cpp.llama_perf_context_reset(model._ctx.ctx)
+        start_time = perf_counter()
 
+        if cached_response is not None:
+            res = cached_response
+            prompt_tokens = None
+            completion_tokens = 0
+        elif chunked:
+            res = process_in_chunks(
+                model,
+                instructions + code_marker,
+                code,
+                "java" if prompt_type == 0 else "uml",
+                max_tokens=max_tokens,
+                grammar=grammar,
+            )
+            prompt_tokens = None
+            completion_tokens = None
+        else:
+            output = model.create_chat_completion(
+                messages=[
+                    {
+                        "role": "system",
+                        "content": utils.SYSTEM_PROMPT,
+                    },
+                    {"role": "user", "content": current_prompt},
+                ],
+                temperature=0.6,
+                max_tokens=max_tokens,
+                top_p=0.95,
+                seed=SEED,
+                stream=False,
+                grammar=grammar,
+            )
             assert isinstance(output, dict)
             res = output["choices"][0]["message"]["content"]
+            prompt_tokens = output["usage"]["prompt_tokens"]
+            completion_tokens = output["usage"]["completion_tokens"]
+
+        latency = perf_counter() - start_time
+        if cached_response is not None:
+            perf = {"prefill_tokens": 0, "prefill_s": None, "decode_s": None, "ttft_s": None}
+        else:
+            perf = read_perf_counters(model)
+        store_answer(
+            role,
+            prompt,
+            res,
+            latency,
+            perf,
+            prompt_tokens,
+            completion_tokens,
+            reused_tokens=reused_tokens,
+            chunked=chunked,
+            cache_hit=cached_response is not None,
+        )
+
+        # Let the machine cool down, only if it needs to
+        if cached_response is None:
+            throttle.wait()
+
+    ledger.close()
+    response_cache.close()
+    if own_throttle:
+        throttle.report()
+    return latencies
+
+
+def schedule_by_length(
+    model_id: str,
+    jobs: list[tuple[str, int, bool]],
+    max_tokens: int,
+    n_ctx_max: int,
+    dataset_path: str | None = None,
+) -> list[tuple[int, dict[tuple[str, int, bool], set[tuple[str, str]]]]]:
+    """
+    Function to group the prompts of all jobs of a model into context size buckets
+
+    INPUTS: model_id = string (model whose tokenizer measures the prompts)
+            jobs = list of (pattern, prompt type, correct)
+            (remaining inputs as in run_model)
+
+    OUTPUTS: list of (context size, job -> set of (role, prompt filename)), smallest context first
+    """
+    tokenizer = token_budget.load_tokenizer(model_id)
+    token_dfs = []
+    for prompt_type in dict.fromkeys(prompt_type for _, prompt_type, _ in jobs):
+        token_df = token_budget.analyze_prompt_set(
+            model_id,
+            prompt_type,
+            tuple(dict.fromkeys(pattern for pattern, _, _ in jobs)),
+            tuple(dict.fromkeys(correct for _, _, correct in jobs)),
+            tokenizer=tokenizer,
+            dataset_path=dataset_path,
+        )
+        token_dfs.append(token_df.assign(Type=prompt_type))
+    del tokenizer
+
+    token_df = pd.concat(token_dfs, ignore_index=True)
+    if token_df.empty:
+        return []
+
+    schedule = []
+    for bucket_n_ctx, bucket_df in token_budget.bucket_by_context(
+        token_df, max_tokens, n_ctx_max
+    ):
+        bucket_jobs = {}
+        for _, row in bucket_df.iterrows():
+            job = (row["Pattern"], int(row["Type"]), row["Correctness"] == "correct")
+            bucket_jobs.setdefault(job, set()).add((row["Role"], row["Prompt"]))
+        print(
+            f"{model_id}: {len(bucket_df)} prompts up to {bucket_df['Tokens'].max()} tokens "
+            f"-> n_ctx={bucket_n_ctx}"
+        )
+        schedule.append((bucket_n_ctx, bucket_jobs))
+    return schedule
+
+
+def partition_cores(
+    n_workers: int, threads_per_worker: int | None = None
+) -> list[list[int]]:
+    """
+    Function to split the cores this process may run on into one disjoint set per worker
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if threads_per_worker is None:
+        threads_per_worker = len(cores) // n_workers
+    assert (
+        threads_per_worker > 0 and n_workers * threads_per_worker <= len(cores)
+    ), f"Cannot give {n_workers} workers {threads_per_worker} of {len(cores)} cores"
+    return [
+        cores[i * threads_per_worker : (i + 1) * threads_per_worker]
+        for i in range(n_workers)
+    ]
+
+
+def pin_to_cores(cores: list[int]) -> None:
+    """
+    Function to restrict the current process to the given cores (no-op where affinity is unsupported)
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def inference_worker(
+    cores: list[int],
+    model_id: str,
+    n_ctx: int,
+    work_items: list,
+    claims,
+    result_queue: multiprocessing.Queue,
+    run_kwargs: dict,
+) -> None:
+    """
+    Function run by every pool worker: loads its own model instance on its cores and runs every
+    work item ((pattern, prompt type, correct), prompt names) once, answering only the prompts it
+    claims from the item's shared counter in claims
+    """
+    pin_to_cores(cores)
+    # use_mmap makes every instance map the same GGUF pages, only the KV caches are per worker
+    model = load_model(
+        model_id, False, n_ctx, run_kwargs.pop("draft_tokens"), n_threads=len(cores)
+    )
+    prefix_cache = open_prefix_cache(model_id, n_ctx, run_kwargs.pop("prefix_cache"))
+    # The other workers keep the CPU busy on purpose, only heat pauses a worker
+    throttle = throttle_from_env(fixed_sleep=30, max_cpu_percent=float("inf"))
+
+    def claimer(item: int) -> Callable[[], int]:
+        def claim_prompt() -> int:
+            with claims.get_lock():
+                index = claims[item]
+                claims[item] += 1
+            return index
+
+        return claim_prompt
+
+    latencies = []
+    for item, ((pattern, prompt_type, correct), prompt_names) in enumerate(work_items):
+        try:
+            latencies.extend(
+                run_model(
+                    model_id=model_id,
+                    pattern=pattern,
+                    prompt_type=prompt_type,
+                    correct=correct,
+                    half_power=False,
+                    model=model,
+                    prefix_cache=prefix_cache,
+                    prompt_names=prompt_names,
+                    throttle=throttle,
+                    claim_prompt=claimer(item),
+                    **run_kwargs,
+                )
+            )
+        except FileNotFoundError as e:
+            print(f"No prompts for {pattern} (prompt {prompt_type}, correct={correct}): {e}")
+
+    model.close()
+    throttle.report()
+    result_queue.put(latencies)
+
+
+def run_worker_pool(
+    model_id: str,
+    n_ctx: int,
+    work_items: list,
+    core_sets: list[list[int]],
+    run_kwargs: dict,
+) -> list[float]:
+    """
+    Function to run work items on one model instance per core set. Every worker goes through the
+    items in order, so the per-job setup runs once per worker, and the prompts of an item are
+    handed out one at a time from a shared counter so the workers stay balanced.
+
+    INPUTS: model_id = string (model to inference)
+            n_ctx = int (context size of every instance)
+            work_items = list of ((pattern, prompt type, correct), prompt names or None)
+            core_sets = list of core lists, one per worker (see partition_cores)
+            run_kwargs = dict (remaining run_model arguments, plus draft_tokens and prefix_cache)
+
+    OUTPUTS: per-prompt latencies of all workers
+    """
+    context = multiprocessing.get_context("spawn")
+    claims = context.Array("i", len(work_items))
+    result_queue = context.Queue()
+
+    workers = [
+        context.Process(
+            target=inference_worker,
+            args=(
+                cores,
+                model_id,
+                n_ctx,
+                work_items,
+                claims,
+                result_queue,
+                dict(run_kwargs),
+            ),
+        )
+        for cores in core_sets
+    ]
+    for worker in workers:
+        worker.start()
+
+    latencies = []
+    finished = 0
+    while finished < len(workers):
+        try:
+            latencies.extend(result_queue.get(timeout=10))
+            finished += 1
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                print(f"{len(workers) - finished} workers exited without results")
+                break
+    for worker in workers:
+        worker.join()
+    return latencies
+
+
+def calibration_worker(
+    cores: list[int],
+    model_id: str,
+    n_ctx: int,
+    prompt: str,
+    max_tokens: int,
+    result_queue: multiprocessing.Queue,
+) -> None:
+    """
+    Function run by calibration workers: one timed completion, reports (generated tokens, seconds)
+    """
+    pin_to_cores(cores)
+    model = load_model(model_id, False, n_ctx, n_threads=len(cores))
+    start_time = perf_counter()
+    output = model.create_chat_completion(
+        messages=[
+            {"role": "system", "content": utils.SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+        temperature=0.0,
+        max_tokens=max_tokens,
+        stream=False,
+    )
+    elapsed = perf_counter() - start_time
+    model.close()
+    assert isinstance(output, dict)
+    result_queue.put((output["usage"]["completion_tokens"], elapsed))
+
+
+def calibrate_workers(
+    model_id: str,
+    n_ctx: int,
+    jobs: list[tuple[str, int, bool]],
+    dataset_path: str | None = None,
+    max_tokens: int = 64,
+) -> list[list[int]]:
+    """
+    Function to pick the number of workers (and cores per worker) with the best total throughput.
+    Worker counts double from 1 while every worker keeps at least 2 cores, each layout runs one
+    short completion per worker on the first prompt of the jobs.
+
+    OUTPUTS: core sets of the fastest layout (see partition_cores)
+    """
+    prompt = None
+    for pattern, prompt_type, correct in jobs:
+        try:
+            prompt = utils.load_prompts(prompt_type, correct, pattern, dataset_path)[0][3]
+            break
+        except (FileNotFoundError, IndexError):
+            continue
+    assert prompt is not None, "No prompt to calibrate with"
+
+    context = multiprocessing.get_context("spawn")
+    n_cores = len(partition_cores(1)[0])
+    best_core_sets, best_throughput = partition_cores(1), 0.0
+    n_workers = 1
+    while n_cores // n_workers >= 2:
+        core_sets = partition_cores(n_workers)
+        result_queue = context.Queue()
+        workers = [
+            context.Process(
+                target=calibration_worker,
+                args=(cores, model_id, n_ctx, prompt, max_tokens, result_queue),
+            )
+            for cores in core_sets
+        ]
+        for worker in workers:
+            worker.start()
+        results = [result_queue.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        # Workers run side by side, so the slowest one bounds the layout
+        throughput = sum(tokens for tokens, _ in results) / max(
+            elapsed for _, elapsed in results
+        )
+        print(
+            f"Calibration: {n_workers} workers x {len(core_sets[0])} cores -> "
+            f"{throughput:.2f} tokens/s"
+        )
+        if throughput > best_throughput:
+            best_core_sets, best_throughput = core_sets, throughput
+        n_workers *= 2
+
+    print(
+        f"Using {len(best_core_sets)} workers x {len(best_core_sets[0])} cores "
+        f"({best_throughput:.2f} tokens/s)"
+    )
+    return best_core_sets
+
+
+def run_jobs(
+    model_ids: list[str],
+    patterns: list[str],
+    prompt_types: list[int],
+    correctness: list[bool],
+    half_power: bool,
+    n_ctx: int | None = None,
+    n_ctx_max: int = 32768,
+    max_tokens: int = 1200,
+    dataset_path: str | None = None,
+    prefix_cache: str = "off",
+    chunk_long_prompts: bool = False,
+    draft_tokens: int = 0,
+    structured: bool = False,
+    workers: int = 1,
+    threads_per_worker: int | None = None,
+    parallel: int = 1,
+) -> None:
+    """
+    Function to run a matrix of jobs (models x patterns x prompt types x correct/incorrect),
+    loading every model once and running all of its jobs before moving on to the next one.
+
+    INPUTS: model_ids = list of models to inference
+            patterns, prompt_types, correctness = the rest of the job matrix
+            n_ctx = int (context size, prompts are bucketed by length with a context per bucket when None)
+            workers = int (model instances pinned to their own cores, 0 = choose with a calibration run)
+            threads_per_worker = int (cores per instance, all cores split evenly when None)
+            parallel = int (sequences of the batched context created per bucket, not with workers)
+            (remaining inputs as in run_model)
+
+    OUTPUTS: None
+    """
+    assert workers == 1 or parallel == 1, "Batched decoding cannot be combined with workers"
+    jobs = [
+        (pattern, prompt_type, correct)
+        for pattern in patterns
+        for prompt_type in prompt_types
+        for correct in correctness
+    ]
+
+    throttle = throttle_from_env(fixed_sleep=30)
+    if structured:
+        # Short answers also mean smaller contexts
+        max_tokens = min(max_tokens, VERDICT_MAX_TOKENS)
+
+    # Jobs are grouped by model so each model is loaded exactly once per context size
+    for model_id in dict.fromkeys(model_ids):
+        if n_ctx is None:
+            schedule = schedule_by_length(
+                model_id, jobs, max_tokens, n_ctx_max, dataset_path
+            )
+        else:
+            schedule = [(n_ctx, None)]
+
+        model = None
+        model_prefix_cache = None
+        batched_context = None
+        core_sets = None
+        for bucket_n_ctx, bucket_jobs in schedule:
+            # Buckets grow, so the context is only rebuilt when a bigger one is needed
+            # (the weights are loaded once, bigger buckets only get a new context)
+            if workers == 1 and (model is None or bucket_n_ctx > model.n_ctx()):
+                print(f"Context size for {model_id}: {bucket_n_ctx}")
+                if model is None:
+                    model = load_model(model_id, half_power, bucket_n_ctx, draft_tokens)
+                else:
+                    resize_context(model, bucket_n_ctx)
+                model_prefix_cache = open_prefix_cache(
+                    model_id, bucket_n_ctx, prefix_cache
+                )
+                # One batched context per loaded context size, on top of the model's own KV cache
+                if batched_context is not None:
+                    batched_context.close()
+                batched_context = (
+                    BatchedContext(model, parallel, bucket_n_ctx) if parallel > 1 else None
+                )
+
+            # Every bucket starts its own pool, each worker process loads the weights for it
+            if workers != 1:
+                if core_sets is None:
+                    core_sets = (
+                        calibrate_workers(
+                            model_id, bucket_n_ctx, jobs, dataset_path
+                        )
+                        if workers == 0
+                        else partition_cores(workers, threads_per_worker)
+                    )
+                # One work item per job, the workers share out its prompts
+                work_items = [
+                    (job, None if bucket_jobs is None else bucket_jobs[job])
+                    for job in jobs
+                    if bucket_jobs is None or job in bucket_jobs
+                ]
+                latencies = run_worker_pool(
+                    model_id,
+                    bucket_n_ctx,
+                    work_items,
+                    core_sets,
+                    {
+                        "max_tokens": max_tokens,
+                        "dataset_path": dataset_path,
+                        "prefix_cache": prefix_cache,
+                        "chunk_long_prompts": chunk_long_prompts,
+                        "draft_tokens": draft_tokens,
+                        "structured": structured,
+                    },
+                )
+                print(
+                    f"Bucket n_ctx={bucket_n_ctx}: {len(latencies)} prompts on "
+                    f"{len(core_sets)} workers, mean latency "
+                    f"{sum(latencies) / max(len(latencies), 1):.2f}s"
+                )
+                continue
+
+            latencies = []
+            for job in jobs:
+                if bucket_jobs is not None and job not in bucket_jobs:
+                    continue
+                pattern, prompt_type, correct = job
+                try:
+                    latencies.extend(
+                        run_model(
+                            model_id=model_id,
+                            pattern=pattern,
+                            prompt_type=prompt_type,
+                            correct=correct,
+                            half_power=half_power,
+                            max_tokens=max_tokens,
+                            dataset_path=dataset_path,
+                            model=model,
+                            prefix_cache=model_prefix_cache,
+                            prompt_names=(
+                                None if bucket_jobs is None else bucket_jobs[job]
+                            ),
+                            throttle=throttle,
+                            chunk_long_prompts=chunk_long_prompts,
+                            structured=structured,
+                            parallel=parallel,
+                            batched_context=batched_context,
+                        )
+                    )
+                except FileNotFoundError as e:
+                    print(f"No prompts for {pattern} (prompt {prompt_type}, correct={correct}): {e}")
+
+            print(
+                f"Bucket n_ctx={bucket_n_ctx}: {len(latencies)} prompts, "
+                f"mean latency {sum(latencies) / max(len(latencies), 1):.2f}s, "
+                f"RSS {psutil.Process().memory_info().rss / 1024**2:.0f} MB, "
+                f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB"
+            )
+
+        # Release the model before the next one is loaded
+        if batched_context is not None:
+            batched_context.close()
+        if model is not None:
+            model.close()
+            del model
+
+    throttle.report()
+
+
+def verdict_token_ids(model: Llama) -> tuple[list[int], list[int]]:
+    """
+    Function to find the first tokens of the YES and NO spellings in the model's vocabulary
+    (tokens shared by both verdicts are left out)
+    """
+    token_ids = {
+        verdict: {
+            model.tokenize(variant.encode("utf-8"), add_bos=False, special=False)[0]
+            for variant in variants
+        }
+        for verdict, variants in VERDICT_VARIANTS.items()
+    }
+    shared = token_ids["YES"] & token_ids["NO"]
+    return sorted(token_ids["YES"] - shared), sorted(token_ids["NO"] - shared)
+
+
+def score_verdict(
+    model: Llama, prompt: str, yes_ids: list[int], no_ids: list[int]
+) -> tuple[float, float, int]:
+    """
+    Function to prefill a prompt and read the next-token log-probabilities of the verdicts,
+    without decoding anything
+
+    INPUTS: model = Llama (loaded model)
+            prompt = string (prompt text)
+            yes_ids, no_ids = lists of token ids (see verdict_token_ids)
+
+    OUTPUTS: (log P(YES) - log P(NO), probability mass on the verdict tokens, prompt tokens)
+    """
+    tokens = model.tokenize(
+        token_budget.format_chat_prompt(prompt).encode("utf-8"),
+        add_bos=True,
+        special=True,
+    )
+    if len(tokens) > model.n_ctx():
+        raise ValueError(f"{len(tokens)} tokens do not fit in n_ctx={model.n_ctx()}")
+    # Keep the prefix already in the KV cache, at least one token is evaluated for its logits
+    reused_tokens = min(
+        Llama.longest_token_prefix(model._input_ids.tolist(), tokens), len(tokens) - 1
+    )
+    if reused_tokens > 0:
+        model.n_tokens = reused_tokens
+    else:
+        model.reset()
+    model.eval(tokens[reused_tokens:])
+
+    # Read from the context: Llama.scores is only filled when every position keeps its logits
+    logits = np.ctypeslib.as_array(
+        model._ctx.get_logits_ith(-1), shape=(model.n_vocab(),)
+    ).astype(np.float64)
+    log_probs = logits - np.logaddexp.reduce(logits)
+    log_yes = np.logaddexp.reduce(log_probs[yes_ids])
+    log_no = np.logaddexp.reduce(log_probs[no_ids])
+    return float(log_yes - log_no), float(np.exp(log_yes) + np.exp(log_no)), len(tokens)
+
+
+def score_prompts(
+    model_id: str,
+    jobs: list[tuple[str, int, bool]],
+    model_for: Callable[[int], Llama],
+    select: Callable[[str], bool],
+    n_ctx_max: int = 32768,
+    dataset_path: str | None = None,
+):
+    """
+    Function to score the selected prompts of a job matrix, one context size bucket at a time
+
+    INPUTS: model_id = string (model to inference)
+            jobs = list of (pattern, prompt type, correct)
+            model_for = function returning the loaded model with a context of at least the given size
+            select = function telling from a prompt hash (see run_ledger.prompt_key) whether to score it
+            (remaining inputs as in run_model)
+
+    OUTPUTS: yields (correct, output file path, prompt hash, log-odds) as every prompt is scored
+    """
+    # Only the prompt has to fit, nothing is generated
+    for bucket_n_ctx, bucket_jobs in schedule_by_length(
+        model_id, jobs, 1, n_ctx_max, dataset_path
+    ):
+        model = model_for(bucket_n_ctx)
+        yes_ids, no_ids = verdict_token_ids(model)
+
+        for job in jobs:
+            if job not in bucket_jobs:
+                continue
+            pattern, prompt_type, correct = job
+            for role, prompt, prompt_file_path, prompt_text in utils.load_prompts(
+                prompt_type, correct, pattern, dataset_path
+            ):
+                if (role, prompt) not in bucket_jobs[job]:
+                    continue
+                output_file_path = utils.get_output_path(
+                    prompt_type, model_id, correct, pattern, role, prompt_file_path, "score"
+                )
+                prompt_hash = run_ledger.prompt_key(output_file_path, prompt_text)
+                if not select(prompt_hash):
+                    continue
+                llama_cpp.llama_perf_context_reset(model._ctx.ctx)
+                start_time = perf_counter()
+                try:
+                    log_odds, verdict_mass, prompt_tokens = score_verdict(
+                        model, prompt_text, yes_ids, no_ids
+                    )
+                except ValueError as e:
+                    print(f"Prompt {prompt} could not be scored: {e}")
+                    continue
+                latency = perf_counter() - start_time
+                perf = read_perf_counters(model)
+                print(
+                    f"{pattern}/{role}/{prompt}: log-odds {log_odds:+.2f} "
+                    f"(verdict mass {verdict_mass:.2f}) in {latency:.2f}s"
+                )
+                telemetry.record(
+                    "local",
+                    model_id,
+                    mode="score",
+                    pattern=pattern,
+                    prompt_type=prompt_type,
+                    correct=correct,
+                    role=role,
+                    prompt=prompt,
+                    prompt_tokens=prompt_tokens,
+                    completion_tokens=0,
+                    latency_s=round(latency, 3),
+                    prefill_s=perf["prefill_s"],
+                    prefill_tokens=perf["prefill_tokens"],
+                    log_odds=round(log_odds, 4),
+                    verdict_mass=round(verdict_mass, 4),
+                    held_out=is_calibration_prompt(prompt_hash),
+                    params={"n_ctx": model.n_ctx(), "n_threads": model.n_threads},
+                )
+                yield correct, output_file_path, prompt_hash, log_odds
+
+
+def score_jobs(
+    model_ids: list[str],
+    patterns: list[str],
+    prompt_types: list[int],
+    correctness: list[bool],
+    half_power: bool,
+    n_ctx_max: int = 32768,
+    dataset_path: str | None = None,
+) -> None:
+    """
+    Function to classify prompts from a single forward pass each, instead of generating answers.
+
+    Every prompt is prefilled once and P(YES) is read from the next-token log-odds of YES/NO through a
+    Platt scaling, fitted once per model and prompt type on a held-out split of the correct and incorrect
+    sets (see is_calibration_prompt, those prompts get no output) and stored; the raw probability is used
+    until one exists. The verdict is YES when P(YES) >= 0.5, so it always agrees with the Confidence line,
+    and the labels of the written prompts never enter either. Outputs are written to the "<model>-score" directory as "YES|NO\nConfidence: <P(YES)>" as soon
+    as each prompt is scored, so evaluate_files reads them like any other answer and an interrupted run
+    resumes from the ledger.
+
+    INPUTS: model_ids, patterns, prompt_types, correctness = the job matrix (as in run_jobs)
+            (remaining inputs as in run_model)
+
+    OUTPUTS: None
+    """
+    for model_id in dict.fromkeys(model_ids):
+        # The weights are loaded once per model, bigger buckets only get a new context
+        model = None
+
+        def model_for(n_ctx: int) -> Llama:
+            nonlocal model
+            if model is None:
+                model = load_model(model_id, half_power, n_ctx)
+            elif n_ctx > model.n_ctx():
+                resize_context(model, n_ctx)
+            return model
+
+        for prompt_type in prompt_types:
+            jobs = [
+                (pattern, prompt_type, correct)
+                for pattern in patterns
+                for correct in correctness
+            ]
+
+            # The calibration is fitted before any output is written and never replaced afterwards
+            calibration = load_calibration(model_id, prompt_type)
+            if calibration is None and len(set(correctness)) == 2:
+                held_out = [
+                    (correct, log_odds)
+                    for correct, _, _, log_odds in score_prompts(
+                        model_id,
+                        jobs,
+                        model_for,
+                        is_calibration_prompt,
+                        n_ctx_max,
+                        dataset_path,
+                    )
+                ]
+                labels = [correct for correct, _ in held_out]
+                if any(labels) and not all(labels):
+                    calibration = fit_platt_scaling(
+                        [log_odds for _, log_odds in held_out], labels
+                    )
+                    save_calibration(model_id, prompt_type, calibration)
+                    print(f"Calibration fitted on {len(held_out)} held-out prompts: {calibration}")
+            if calibration is None:
+                print("No calibration yet, confidences are raw probabilities")
+
+            # Outputs written with another calibration are scored again
+            ledger = run_ledger.open_ledger()
+            ledger_params = {
+                "prompt_type": prompt_type,
+                "mode": "score",
+                "calibration": calibration
+                and {"scale": calibration["scale"], "bias": calibration["bias"]},
+            }
+            completed_prompts = run_ledger.completed_prompts(
+                ledger, "local", model_id, ledger_params
+            )
+
+            written = 0
+            for _, output_file_path, prompt_hash, log_odds in score_prompts(
+                model_id,
+                jobs,
+                model_for,
+                lambda prompt_hash: not is_calibration_prompt(prompt_hash)
+                and prompt_hash not in completed_prompts,
+                n_ctx_max,
+                dataset_path,
+            ):
+                confidence = calibrated_confidence(log_odds, calibration)
+                run_ledger.write_output_atomic(
+                    output_file_path,
+                    f"{'YES' if confidence >= 0.5 else 'NO'}\n"
+                    f"Confidence: {confidence:.4f}\n",
+                )
+                run_ledger.record_completion(
+                    ledger, "local", model_id, prompt_hash, ledger_params, output_file_path
+                )
+                written += 1
+            ledger.close()
+            print(f"{written} verdicts written for {model_id} (prompt {prompt_type})")
 
-            output_file_path = os.path.join(
-                ["code-outputs", "uml-outputs", "summary-outputs"][prompt_type],
-                model_id.replace(":free", ""),
-                "correct" if correct else "incorrect",
-                pattern,
-                role,
-                f"{os.path.basename(current_prompt_file_path)}",
+        if model is not None:
+            model.close()
+            del model
+
+
+def benchmark_draft(
+    model_id: str,
+    patterns: list[str],
+    prompt_type: int,
+    half_power: bool,
+    n_prompts: int = 5,
+    draft_tokens: int = 10,
+    max_tokens: int = 1200,
+    n_ctx_max: int = 32768,
+    dataset_path: str | None = None,
+) -> None:
+    """
+    Function to compare generation speed with and without prompt lookup decoding on the same prompts.
+    Nothing is written to the output folders.
+
+    INPUTS: model_id = string (model to benchmark)
+            patterns = list of patterns, the first n_prompts correct prompts of each are used
+            draft_tokens = int (tokens predicted per lookup)
+            (remaining inputs as in run_model)
+
+    OUTPUTS: None
+    """
+    prompts = []
+    for pattern in patterns:
+        try:
+            pattern_prompts = utils.load_prompts(prompt_type, True, pattern, dataset_path)
+        except FileNotFoundError:
+            continue
+        prompts.extend(prompt_text for _, _, _, prompt_text in pattern_prompts[:n_prompts])
+
+    tokenizer = token_budget.load_tokenizer(model_id)
+    token_counts = token_budget.count_prompt_tokens(tokenizer, model_id, prompts)
+    del tokenizer
+    n_ctx, overflowing = token_budget.choose_context_size(
+        token_counts, max_tokens, n_ctx_max
+    )
+    prompts = [prompt for i, prompt in enumerate(prompts) if i not in overflowing]
+    print(f"Benchmarking {len(prompts)} prompts with n_ctx={n_ctx}")
+
+    results = {}
+    for label, model_draft_tokens in (("top-p", 0), ("prompt lookup", draft_tokens)):
+        model = load_model(model_id, half_power, n_ctx, model_draft_tokens)
+        generated_tokens = 0
+        elapsed = 0.0
+        for prompt in prompts:
+            # Same seed for both runs, and no prompt prefix carried over between prompts
+            model.reset()
+            model.set_seed(42)
+            start_time = perf_counter()
+            output = model.create_chat_completion(
+                messages=[
+                    {"role": "system", "content": utils.SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.6,
+                max_tokens=max_tokens,
+                top_p=0.95,
+                stream=False,
             )
+            elapsed += perf_counter() - start_time
+            assert isinstance(output, dict)
+            generated_tokens += output["usage"]["completion_tokens"]
+        results[label] = generated_tokens / elapsed
+        print(
+            f"{label}: {generated_tokens} tokens in {elapsed:.1f}s "
+            f"({results[label]:.2f} tokens/s)"
+        )
+        model.close()
+        del model
+
+    print(
+        f"{model_id} prompt {prompt_type}: prompt lookup runs at "
+        f"{results['prompt lookup'] / results['top-p']:.2f}x the top-p speed"
+    )
+
+
+def benchmark_batched(
+    model_id: str,
+    patterns: list[str],
+    prompt_type: int,
+    half_power: bool,
+    n_prompts: int = 5,
+    parallel: int = 4,
+    max_tokens: int = 1200,
+    n_ctx_max: int = 32768,
+    dataset_path: str | None = None,
+) -> None:
+    """
+    Function to compare the aggregate throughput of batched decoding against one prompt at a time.
+    Nothing is written to the output folders.
+
+    INPUTS: model_id = string (model to benchmark)
+            patterns = list of patterns, the first n_prompts correct prompts of each are used
+            parallel = int (sequences decoded together)
+            (remaining inputs as in run_model)
 
-            # Check directory presence
-            utils.check_path_existence(os.path.dirname(output_file_path))
+    OUTPUTS: None
+    """
+    prompts = []
+    for pattern in patterns:
+        try:
+            pattern_prompts = utils.load_prompts(prompt_type, True, pattern, dataset_path)
+        except FileNotFoundError:
+            continue
+        prompts.extend(prompt_text for _, _, _, prompt_text in pattern_prompts[:n_prompts])
 
-            print(f"Response received.... Writing to {output_file_path}")
+    tokenizer = token_budget.load_tokenizer(model_id)
+    token_counts = token_budget.count_prompt_tokens(tokenizer, model_id, prompts)
+    del tokenizer
+    n_ctx, overflowing = token_budget.choose_context_size(
+        token_counts, max_tokens, n_ctx_max
+    )
+    prompts = [prompt for i, prompt in enumerate(prompts) if i not in overflowing]
+    print(f"Benchmarking {len(prompts)} prompts with n_ctx={n_ctx}")
 
-            try:
-                with open(output_file_path, "w") as output_file:
-                    output_file.write(str(res))
-                    print("Output sorted....")
+    model = load_model(model_id, half_power, n_ctx)
 
-            except FileExistsError as e:
-                logger.error(f"Error occurred: {e}")
-                print("Error message received and logged... Aborting")
-                sys.exit(1)
+    generated_tokens = 0
+    start_time = perf_counter()
+    for prompt in prompts:
+        output = model.create_chat_completion(
+            messages=[
+                {"role": "system", "content": utils.SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0.6,
+            max_tokens=max_tokens,
+            top_p=0.95,
+            stream=False,
+        )
+        assert isinstance(output, dict)
+        generated_tokens += output["usage"]["completion_tokens"]
+    sequential = generated_tokens / (perf_counter() - start_time)
+    print(f"sequential: {generated_tokens} tokens ({sequential:.2f} tokens/s)")
 
-            except FileNotFoundError as e:
-                logger.error(f"Error occurred: {e}")
-                print("Error message received and logged... Aborting")
-                sys.exit(2)
+    batched_context = BatchedContext(model, parallel, n_ctx)
+    start_time = perf_counter()
+    generated_tokens = sum(
+        result["completion_tokens"]
+        for _, result in generate_batched(batched_context, prompts, max_tokens=max_tokens)
+    )
+    batched = generated_tokens / (perf_counter() - start_time)
+    print(f"batched x{parallel}: {generated_tokens} tokens ({batched:.2f} tokens/s)")
 
-            # Add some delay to let the machine cool down
-            sleep(30)
+    batched_context.close()
+    model.close()
+    print(
+        f"{model_id} prompt {prompt_type}: batched decoding runs at "
+        f"{batched / sequential:.2f}x the sequential throughput"
+    )
 
 
 def main():
@@ -199,37 +1645,161 @@ def main():
     parser = argparse.ArgumentParser(description="Inference a model via model_id")
 
     # Arguments
-    parser.add_argument("--model", type=str, help="Path to model's GGUF file")
-    parser.add_argument("--pattern", type=str, help="Pattern name to inference")
-    parser.add_argument("--prompt", type=int, help="What prompts to use")
+    parser.add_argument(
+        "--model", type=str, nargs="+", help="Model(s) to inference, each loaded once"
+    )
+    parser.add_argument(
+        "--pattern", type=str, nargs="+", help="Pattern name(s) to inference"
+    )
+    parser.add_argument("--prompt", type=int, nargs="+", help="What prompts to use")
     parser.add_argument(
         "--correct",
         action=argparse.BooleanOptionalAction,
-        help="Test for correct or incorrect appearance",
+        help="Test for correct or incorrect appearance (both when omitted)",
     )
     parser.add_argument(
         "--half",
         action=argparse.BooleanOptionalAction,
         help="Whether to use full or half threads",
     )
+    parser.add_argument(
+        "--n-ctx",
+        type=int,
+        default=None,
+        help="Context size (default: smallest fitting the prompts)",
+    )
+    parser.add_argument(
+        "--n-ctx-max", type=int, default=32768, help="Largest context allowed"
+    )
+    parser.add_argument(
+        "--dataset", type=str, default=None, help="Packed prompt dataset to read"
+    )
+    parser.add_argument(
+        "--prefix-cache",
+        choices=["off", "ram", "disk"],
+        default="off",
+        help="Evaluate the shared prompt prefix once and resume every prompt from it",
+    )
+    parser.add_argument(
+        "--chunk",
+        action="store_true",
+        help="Process prompts longer than --n-ctx-max in chunks instead of skipping them",
+    )
+    parser.add_argument(
+        "--draft",
+        type=int,
+        nargs="?",
+        const=10,
+        default=0,
+        help="Prompt lookup speculative decoding, optionally with the tokens predicted per step "
+        "(keeps the logits of every position: n_ctx x vocabulary x 4 bytes of extra memory)",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=None,
+        help="Compare tokens/s of --draft (or --parallel) with the default path on this many prompts per pattern",
+    )
+    parser.add_argument(
+        "--structured",
+        action="store_true",
+        help="Constrain answers to YES/NO followed by at most 3 sentences",
+    )
+    parser.add_argument(
+        "--score",
+        action="store_true",
+        help="Read the verdict from YES/NO log-probabilities instead of generating answers",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Prompts decoded together in one batched context",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Model instances pinned to separate cores (0 = calibrate)",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="Cores per worker (default: all cores split evenly)",
+    )
 
     args = parser.parse_args()
 
     assert args.model, "Model name cannot be empty..."
     assert args.pattern, "Pattern name cannot be empty..."
-    assert (
-        isinstance(args.prompt, int) and 0 <= args.prompt and args.prompt <= 2
+    assert args.prompt and all(
+        isinstance(prompt, int) and 0 <= prompt and prompt <= 2 for prompt in args.prompt
     ), "Prompt type not valid..."
-    assert isinstance(args.correct, bool), "Correct must be a boolean"
+    assert args.correct is None or isinstance(
+        args.correct, bool
+    ), "Correct must be a boolean"
     assert isinstance(args.half, bool), "Half must be a boolean"
+    assert (
+        args.workers == 1 or args.parallel == 1
+    ), "--parallel cannot be combined with --workers"
+
+    if args.score:
+        score_jobs(
+            model_ids=args.model,
+            patterns=args.pattern,
+            prompt_types=args.prompt,
+            correctness=[True, False] if args.correct is None else [args.correct],
+            half_power=args.half,
+            n_ctx_max=args.n_ctx_max,
+            dataset_path=args.dataset,
+        )
+        return
+
+    if args.benchmark is not None:
+        for model_id in args.model:
+            for prompt_type in args.prompt:
+                if args.parallel > 1:
+                    benchmark_batched(
+                        model_id,
+                        args.pattern,
+                        prompt_type,
+                        args.half,
+                        n_prompts=args.benchmark,
+                        parallel=args.parallel,
+                        n_ctx_max=args.n_ctx_max,
+                        dataset_path=args.dataset,
+                    )
+                    continue
+                benchmark_draft(
+                    model_id,
+                    args.pattern,
+                    prompt_type,
+                    args.half,
+                    n_prompts=args.benchmark,
+                    draft_tokens=args.draft or 10,
+                    n_ctx_max=args.n_ctx_max,
+                    dataset_path=args.dataset,
+                )
+        return
 
     # Run the inferencing script
-    run_model(
-        model_id=args.model,
-        pattern=args.pattern,
-        prompt_type=args.prompt,
-        correct=args.correct,
+    run_jobs(
+        model_ids=args.model,
+        patterns=args.pattern,
+        prompt_types=args.prompt,
+        correctness=[True, False] if args.correct is None else [args.correct],
         half_power=args.half,
+        n_ctx=args.n_ctx,
+        n_ctx_max=args.n_ctx_max,
+        dataset_path=args.dataset,
+        prefix_cache=args.prefix_cache,
+        chunk_long_prompts=args.chunk,
+        draft_tokens=args.draft,
+        structured=args.structured,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        parallel=args.parallel,
     )
 
 
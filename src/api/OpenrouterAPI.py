@@ -1,20 +1,240 @@
 # from openai import OpenAI
 import os
-import sys
-import json
+import random
+import argparse
 import requests
 import logging
-from .. import utils
-from time import sleep
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .. import utils, telemetry, run_ledger
+from ..cache import open_response_cache, response_key
+from ..rate_limit import RateLimiter, retry_after_seconds
+from ..verdict import VERDICT_MAX_TOKENS, VERDICT_SCHEMA, parse_verdict_json
+from time import sleep, perf_counter
 
+OPENROUTER_BASE_URL = os.environ.get(
+    "OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1"
+)
+CONCURRENCY = 4
+REQUESTS_PER_MINUTE = 20
+TOKENS_PER_MINUTE = 200_000
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 2.0
+REQUEST_TIMEOUT = 300
+# Completion tokens assumed for the rate limit until the real usage is known
+COMPLETION_TOKEN_ESTIMATE = 600
 
-def run_model(model_name: str, pattern: str, prompt_type: int, correct: bool) -> None:
+
+def create_session(concurrency: int = CONCURRENCY) -> requests.Session:
+    """
+    Function to create a requests Session keeping one pooled connection per concurrent request
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {
+            "Authorization": f"Bearer {os.getenv("OPENROUTER_API_KEY")}",
+            "Content-Type": "application/json",
+        }
+    )
+    return session
+
+
+def post_completion(
+    session: requests.Session,
+    url: str,
+    request_body: dict,
+    limiter: RateLimiter,
+    estimated_tokens: int,
+    logger: logging.Logger,
+) -> tuple[dict | None, int | None, float]:
+    """
+    Function to send one chat completion request within the rate limits, retrying network errors,
+    429 and 5xx responses (Retry-After when the server sends one, exponential backoff otherwise)
+
+    OUTPUTS: (response JSON or None when every attempt failed, HTTP status, latency of the last attempt)
+    """
+    status = None
+    latency = 0.0
+    for attempt in range(MAX_RETRIES + 1):
+        backoff = BACKOFF_SECONDS * 2**attempt + random.uniform(0, 1)
+        limiter.acquire(estimated_tokens)
+        start_time = perf_counter()
+        try:
+            response = session.post(url, json=request_body, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            limiter.settle(estimated_tokens, 0)
+            logger.warning(f"Request failed ({e}), retrying in {backoff:.1f}s")
+            sleep(backoff)
+            continue
+        latency = perf_counter() - start_time
+        status = response.status_code
+
+        if status == 429 or status >= 500:
+            limiter.settle(estimated_tokens, 0)
+            wait = retry_after_seconds(response.headers.get("Retry-After"), backoff)
+            if status == 429:
+                # Everyone waits, not only this request
+                limiter.pause(wait)
+            logger.warning(f"HTTP {status} from {url}, retrying in {wait:.1f}s")
+            sleep(wait)
+            continue
+
+        try:
+            return response.json(), status, latency
+        except ValueError:
+            logger.error(f"HTTP {status}: response is not JSON: {response.text[:500]}")
+            return None, status, latency
+
+    logger.error(f"Giving up after {MAX_RETRIES + 1} attempts (last status {status})")
+    return None, status, latency
+
+
+def answer_prompt(
+    session: requests.Session,
+    limiter: RateLimiter,
+    base_url: str,
+    model_name: str,
+    pattern: str,
+    prompt_type: int,
+    correct: bool,
+    role: str,
+    prompt: str,
+    prompt_text: str,
+    output_file_path: str,
+    structured: bool,
+    logger: logging.Logger,
+    response_cache=None,
+) -> bool:
+    """
+    Function to request the answer to one prompt and store it (runs in the worker threads).
+    An identical request already in `response_cache` is answered from it without calling the API.
+
+    OUTPUTS: True when the answer was written
+    """
+    request_body = {
+        "model": model_name,
+        "messages": [{"role": "user", "content": prompt_text}],
+    }
+    if structured:
+        request_body["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "verdict",
+                "strict": True,
+                "schema": VERDICT_SCHEMA,
+            },
+        }
+        request_body["max_tokens"] = VERDICT_MAX_TOKENS
+    estimated_tokens = len(prompt_text) // 4 + (
+        VERDICT_MAX_TOKENS if structured else COMPLETION_TOKEN_ESTIMATE
+    )
+
+    cache_key = response_key(
+        "openrouter",
+        model_name,
+        request_body["messages"],
+        {k: v for k, v in request_body.items() if k not in ("model", "messages")},
+    )
+    cached_content = response_cache.get(cache_key) if response_cache is not None else None
+    if cached_content is not None:
+        telemetry.record(
+            "openrouter",
+            model_name,
+            pattern=pattern,
+            prompt_type=prompt_type,
+            correct=correct,
+            role=role,
+            prompt=prompt,
+            cache_hit=True,
+            params={"structured": structured},
+        )
+        run_ledger.write_output_atomic(output_file_path, cached_content)
+        print(f"Cached response for {prompt}.... Written to {output_file_path}")
+        return True
+
+    print(f"Request sent to {model_name} for {prompt}....")
+    response_json, status, latency = post_completion(
+        session,
+        f"{base_url}/chat/completions",
+        request_body,
+        limiter,
+        estimated_tokens,
+        logger,
+    )
+    if response_json is None:
+        return False
+
+    usage = response_json.get("usage") or {}
+    limiter.settle(estimated_tokens, usage.get("total_tokens", estimated_tokens))
+    telemetry.record(
+        "openrouter",
+        model_name,
+        pattern=pattern,
+        prompt_type=prompt_type,
+        correct=correct,
+        role=role,
+        prompt=prompt,
+        status=status,
+        prompt_tokens=usage.get("prompt_tokens"),
+        completion_tokens=usage.get("completion_tokens"),
+        latency_s=round(latency, 3),
+        provider=response_json.get("provider"),
+        params={"structured": structured},
+    )
+
+    try:
+        content = response_json["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError) as e:
+        logger.error(
+            f"An error occurred: {e}\nResponse Received:\n{response_json}\n\n",
+            exc_info=True,
+        )
+        print(f"Error Message Received and Logged for {prompt}... Skipping")
+        return False
+
+    if structured:
+        try:
+            content = parse_verdict_json(content)
+        except ValueError as e:
+            logger.warning(f"{output_file_path}: {e}, storing raw answer")
+    run_ledger.write_output_atomic(output_file_path, content + "\n")
+    if response_cache is not None:
+        response_cache.set(cache_key, content + "\n")
+    print(f"Response Received.... Written to {output_file_path}")
+    return True
+
+
+def run_model(
+    model_name: str,
+    pattern: str,
+    prompt_type: int,
+    correct: bool,
+    dataset_path: str | None = None,
+    structured: bool = False,
+    concurrency: int = CONCURRENCY,
+    requests_per_minute: float = REQUESTS_PER_MINUTE,
+    tokens_per_minute: float | None = TOKENS_PER_MINUTE,
+    base_url: str = OPENROUTER_BASE_URL,
+    session: requests.Session | None = None,
+    limiter: RateLimiter | None = None,
+    response_cache=None,
+) -> None:
     """
     Function to inference LLM using Openrouter API methods and store results in appropriate files.
 
     INPUTS: model_name = string (which model to inference)
             pattern = string (which pattern to identify)
             correct = bool (whether to decipher for correct files or not)
+            dataset_path = string (packed prompt dataset, prompt directories when None)
+            structured = bool (ask for a JSON verdict with a bounded explanation)
+            concurrency = int (requests in flight)
+            requests_per_minute, tokens_per_minute = budgets shared by all requests
+            base_url = string (API root, e.g. a local mock server)
+            session, limiter = shared between calls when provided (created otherwise)
+            response_cache = diskcache.Cache of identical requests (cache.open_response_cache() when None)
 
     OUTPUTS: None
     """
@@ -28,82 +248,173 @@ def run_model(model_name: str, pattern: str, prompt_type: int, correct: bool) ->
 
     logger = logging.getLogger(__name__)
 
-    # Declarations
-    common_prompt_path = ["prompts-code", "prompts-uml", "prompts-summary"][prompt_type]
+    session = session if session is not None else create_session(concurrency)
+    limiter = (
+        limiter
+        if limiter is not None
+        else RateLimiter(requests_per_minute, tokens_per_minute)
+    )
+    own_response_cache = response_cache is None
+    if own_response_cache:
+        response_cache = open_response_cache()
 
-    pattern_prompt_path = os.path.join(
-        common_prompt_path, "correct" if correct else "incorrect", pattern
+    # Declarations
+    prompts = utils.load_prompts(prompt_type, correct, pattern, dataset_path)
+    ledger = run_ledger.open_ledger()
+    ledger_params = {
+        "prompt_type": prompt_type,
+        "mode": "structured" if structured else "generate",
+    }
+    completed_prompts = run_ledger.completed_prompts(
+        ledger, "openrouter", model_name, ledger_params
     )
-    collected_prompts = utils.check_collected_prompts(model_name, correct, prompt_type)
+    prompt_outputs = []
+    for role, prompt, current_prompt_file_path, current_prompt in prompts:
+        output_file_path = utils.get_output_path(
+            prompt_type,
+            model_name,
+            correct,
+            pattern,
+            role,
+            current_prompt_file_path,
+            ledger_params["mode"],
+        )
+        prompt_outputs.append(
+            (run_ledger.prompt_key(output_file_path, current_prompt), output_file_path)
+        )
+    # Outputs written before the ledger existed are not requested (and paid for) again
+    adopted_prompts = run_ledger.adopt_existing_outputs(
+        ledger,
+        "openrouter",
+        model_name,
+        ledger_params,
+        {
+            prompt_hash: output_file_path
+            for prompt_hash, output_file_path in prompt_outputs
+            if prompt_hash not in completed_prompts
+        },
+    )
+    if adopted_prompts:
+        print(f"{len(adopted_prompts)} existing outputs adopted into the run ledger")
+    completed_prompts |= adopted_prompts
 
-    # Iterate over all prompt files
-    for i, role in enumerate(os.listdir(pattern_prompt_path)):
-        role_path = os.path.join(pattern_prompt_path, role)
-        for j, prompt in enumerate(
-            sorted(os.listdir(role_path), key=lambda x: int(x[:2].strip()))
+    # Keep `concurrency` requests in flight, the ledger is only written from this thread
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for (role, prompt, _, current_prompt), (prompt_hash, output_file_path) in zip(
+            prompts, prompt_outputs
         ):
-            # Make request payload ready for one project file
-            current_prompt_file_path = os.path.join(role_path, prompt)
-            if (
-                os.path.sep.join(current_prompt_file_path.split(os.path.sep)[2:])
-                in collected_prompts
-            ):
+            if prompt_hash in completed_prompts:
                 print(f"Prompt {prompt} already used.... Skipping")
                 continue
-            with open(current_prompt_file_path, "r") as current_prompt_file:
-                current_prompt = current_prompt_file.read()
-
-            print(f"Loaded prompt {os.path.basename(current_prompt_file_path)}....")
-
-            data_payload = json.dumps(
-                {
-                    "model": model_name,
-                    "messages": [{"role": "user", "content": current_prompt}],
-                }
-            )
-            url_payload = "https://openrouter.ai/api/v1/chat/completions"
-            header_payload = {
-                "Authorization": f"Bearer {os.getenv("OPENROUTER_API_KEY")}",
-                "Content-Type": "application/json",
-            }
-
-            print(f"Request sent to {model_name}....")
-            # Send request to Openrouter API to provide the response
-            response = requests.post(
-                url=url_payload,
-                headers=header_payload,
-                data=data_payload,
-            )
 
-            # Store the response to appropriate file
-            output_file_path = os.path.join(
-                ["code-outputs", "uml-outputs", "summary-outputs"][prompt_type],
-                model_name.replace(":free", ""),
-                "correct" if correct else "incorrect",
+            future = executor.submit(
+                answer_prompt,
+                session,
+                limiter,
+                base_url,
+                model_name,
                 pattern,
+                prompt_type,
+                correct,
                 role,
-                f"{os.path.basename(current_prompt_file_path)}",
+                prompt,
+                current_prompt,
+                output_file_path,
+                structured,
+                logger,
+                response_cache,
             )
+            futures[future] = (prompt_hash, output_file_path)
 
-            # Check the presence of directories
-            utils.check_path_existence(os.path.dirname(output_file_path))
+        for future in as_completed(futures):
+            prompt_hash, output_file_path = futures[future]
+            try:
+                answered = future.result()
+            except Exception as e:
+                logger.error(f"{output_file_path}: {e}", exc_info=True)
+                continue
+            if answered:
+                run_ledger.record_completion(
+                    ledger,
+                    "openrouter",
+                    model_name,
+                    prompt_hash,
+                    ledger_params,
+                    output_file_path,
+                )
 
-            print(f"Response Received.... Writing to {output_file_path}")
+    ledger.close()
+    if own_response_cache:
+        response_cache.close()
+    print("Output Stored...")
 
-            try:
-                with open(output_file_path, "w") as output_file:
-                    output_file.write(
-                        response.json()["choices"][0]["message"]["content"] + "\n"
-                    )
 
-                print("Output Stored...")
+def main():
+    # Create Parser
+    parser = argparse.ArgumentParser(description="Inference a model through Openrouter")
+
+    # Arguments
+    parser.add_argument("--model", type=str, help="Model to inference")
+    parser.add_argument("--pattern", type=str, nargs="+", help="Pattern name(s)")
+    parser.add_argument("--prompt", type=int, nargs="+", help="What prompts to use")
+    parser.add_argument(
+        "--correct",
+        action=argparse.BooleanOptionalAction,
+        help="Test for correct or incorrect appearance (both when omitted)",
+    )
+    parser.add_argument(
+        "--dataset", type=str, default=None, help="Packed prompt dataset to read"
+    )
+    parser.add_argument(
+        "--structured", action="store_true", help="Ask for a JSON verdict"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=CONCURRENCY, help="Requests in flight"
+    )
+    parser.add_argument(
+        "--rpm", type=float, default=REQUESTS_PER_MINUTE, help="Requests per minute"
+    )
+    parser.add_argument(
+        "--tpm", type=float, default=TOKENS_PER_MINUTE, help="Tokens per minute (0 = no limit)"
+    )
+    parser.add_argument(
+        "--base-url", type=str, default=OPENROUTER_BASE_URL, help="API root URL"
+    )
+
+    args = parser.parse_args()
+
+    assert args.model, "Model name cannot be empty..."
+    assert args.pattern, "Pattern name cannot be empty..."
+    assert args.prompt and all(
+        0 <= prompt and prompt <= 2 for prompt in args.prompt
+    ), "Prompt type not valid..."
+
+    # One session, one budget and one response cache for the whole run
+    session = create_session(args.concurrency)
+    limiter = RateLimiter(args.rpm, args.tpm or None)
+    response_cache = open_response_cache()
+    for pattern in args.pattern:
+        for prompt_type in args.prompt:
+            for correct in [True, False] if args.correct is None else [args.correct]:
+                try:
+                    run_model(
+                        args.model,
+                        pattern,
+                        prompt_type,
+                        correct,
+                        dataset_path=args.dataset,
+                        structured=args.structured,
+                        concurrency=args.concurrency,
+                        base_url=args.base_url,
+                        session=session,
+                        limiter=limiter,
+                        response_cache=response_cache,
+                    )
+                except FileNotFoundError as e:
+                    print(f"No prompts for {pattern} (prompt {prompt_type}, correct={correct}): {e}")
+    response_cache.close()
 
-            except KeyError as e:
-                logger.error(
-                    f"An error occurred: {e}\nResponse Received:\n{response.json()}\n\n",
-                    exc_info=True,
-                )
-                print("Error Message Received and Logged... Aborting")
-                sys.exit(1)
 
-            sleep(60 * 2)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from collections import deque
+from typing import Generator
+from time import perf_counter
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from llama_cpp._internals import LlamaBatch, LlamaContext
+from . import token_budget
+
+BATCH_SIZE = 2048
+# create_chat_completion defaults, applied in the same order as llama.cpp's sampler chain
+TOP_K = 40
+MIN_P = 0.05
+
+
+def sample_token(
+    logits: np.ndarray,
+    temperature: float,
+    top_p: float,
+    rng: np.random.Generator,
+    top_k: int = TOP_K,
+    min_p: float = MIN_P,
+) -> int:
+    """
+    Function to sample the next token the way create_chat_completion does: top-k, then top-p and min-p
+    on the untempered probabilities, then temperature over what is left (greedy when temperature is 0)
+    """
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    order = np.argsort(logits)[::-1]
+    if top_k > 0:
+        order = order[:top_k]
+    probabilities = np.exp(logits[order] - logits[order[0]])
+    probabilities /= probabilities.sum()
+    keep = int(np.searchsorted(np.cumsum(probabilities), top_p)) + 1
+    keep = min(keep, int(np.count_nonzero(probabilities >= min_p * probabilities[0])))
+    candidates = order[: max(keep, 1)]
+    tempered = np.exp((logits[candidates] - logits[candidates[0]]) / temperature)
+    return int(rng.choice(candidates, p=tempered / tempered.sum()))
+
+
+class BatchedContext:
+    """
+    Context with `parallel` sequences of n_ctx_seq tokens each, sharing the weights of a loaded model.
+    It is created once and reused by every generate_batched call (one per bucket or run).
+    """
+
+    def __init__(self, model: Llama, parallel: int, n_ctx_seq: int):
+        context_params = llama_cpp.llama_context_default_params()
+        context_params.n_ctx = n_ctx_seq * parallel
+        context_params.n_batch = BATCH_SIZE
+        context_params.n_ubatch = min(BATCH_SIZE, 512)
+        context_params.n_seq_max = parallel
+        context_params.n_threads = model.n_threads
+        context_params.n_threads_batch = model.n_threads_batch
+        self.model = model
+        self.parallel = parallel
+        self.n_ctx_seq = n_ctx_seq
+        self.context = LlamaContext(model=model._model, params=context_params, verbose=False)
+        self.batch = LlamaBatch(n_tokens=BATCH_SIZE, embd=0, n_seq_max=parallel, verbose=False)
+
+    def close(self) -> None:
+        self.context.close()
+        self.batch.close()
+
+
+def generate_batched(
+    batched_context: BatchedContext,
+    prompts: list[str],
+    max_tokens: int = 1200,
+    temperature: float = 0.6,
+    top_p: float = 0.95,
+    seed: int = 42,
+) -> Generator[tuple[int, dict], None, None]:
+    """
+    Function to answer many chat prompts with up to `parallel` sequences decoded together in one context.
+
+    Each step builds one batch: the next token of every decoding sequence first, then as many prompt tokens
+    of the sequences still being prefilled as fit. A finished sequence frees its KV cells and slot, and the
+    next prompt takes it straight away, so the batch stays full until the queue runs dry. Answers are yielded
+    as their sequences finish, so the caller can store each one before the rest are done.
+
+    INPUT:
+        - batched_context -> BatchedContext of the loaded model (parallel sequences of n_ctx_seq tokens)
+        - prompts -> User prompts, sent with utils.SYSTEM_PROMPT in the chat format
+        - max_tokens, temperature, top_p, seed -> Sampling settings, as in create_chat_completion
+          (top_k and min_p keep its defaults, see sample_token); every sequence samples from its own
+          generator seeded with `seed`, so an answer does not depend on the prompts decoded next to it
+
+    OUTPUT:
+        - yields (prompt index, dict) once per prompt, in the order they finish: "text", "prompt_tokens",
+          "completion_tokens", "latency_s" (from admission to the last token) and "error" (None, or why the
+          prompt was not answered)
+    """
+    model = batched_context.model
+    context = batched_context.context
+    batch = batched_context.batch
+    parallel = batched_context.parallel
+    n_ctx_seq = batched_context.n_ctx_seq
+
+    stop_tokens = {
+        model.token_eos(),
+        *model.tokenize(b"<|im_end|>", add_bos=False, special=True)[:1],
+    }
+    n_vocab = model.n_vocab()
+
+    queue = deque(enumerate(prompts))
+    free_slots = list(range(parallel - 1, -1, -1))
+    active = {}
+
+    while queue or active:
+        # Admit prompts into free sequence slots
+        while queue and free_slots:
+            index, prompt = queue.popleft()
+            tokens = model.tokenize(
+                token_budget.format_chat_prompt(prompt).encode("utf-8"),
+                add_bos=True,
+                special=True,
+            )
+            if len(tokens) + max_tokens > n_ctx_seq:
+                yield index, {
+                    "text": "",
+                    "prompt_tokens": len(tokens),
+                    "completion_tokens": 0,
+                    "latency_s": 0.0,
+                    "error": f"{len(tokens) + max_tokens} tokens do not fit in {n_ctx_seq}",
+                }
+                continue
+            seq_id = free_slots.pop()
+            context.kv_cache_seq_rm(seq_id, -1, -1)
+            active[seq_id] = {
+                "index": index,
+                "pending": tokens,
+                "position": 0,
+                "prompt_tokens": len(tokens),
+                "generated": [],
+                "rng": np.random.default_rng(seed),
+                "start_time": perf_counter(),
+            }
+
+        # Decoding sequences get one token each, prefilling ones share what is left of the batch
+        entries = []
+        for seq_id, sequence in active.items():
+            if not sequence["pending"]:
+                entries.append((seq_id, sequence["generated"][-1], True))
+        for seq_id, sequence in active.items():
+            room = BATCH_SIZE - len(entries)
+            if not sequence["pending"] or room <= 0:
+                continue
+            chunk = sequence["pending"][:room]
+            sequence["pending"] = sequence["pending"][room:]
+            for i, token in enumerate(chunk):
+                entries.append(
+                    (seq_id, token, not sequence["pending"] and i == len(chunk) - 1)
+                )
+
+        raw_batch = batch.batch
+        logit_rows = {}
+        for i, (seq_id, token, wants_logits) in enumerate(entries):
+            raw_batch.token[i] = token
+            raw_batch.pos[i] = active[seq_id]["position"]
+            raw_batch.n_seq_id[i] = 1
+            raw_batch.seq_id[i][0] = seq_id
+            raw_batch.logits[i] = wants_logits
+            active[seq_id]["position"] += 1
+            if wants_logits:
+                logit_rows[seq_id] = i
+        raw_batch.n_tokens = len(entries)
+        context.decode(batch)
+
+        # Sample the next token of every sequence that produced logits
+        for seq_id, row in logit_rows.items():
+            sequence = active[seq_id]
+            logits = np.ctypeslib.as_array(
+                context.get_logits_ith(row), shape=(n_vocab,)
+            ).astype(np.float64)
+            token = sample_token(logits, temperature, top_p, sequence["rng"])
+            finished = token in stop_tokens
+            if not finished:
+                sequence["generated"].append(token)
+            if finished or len(sequence["generated"]) >= max_tokens:
+                result = {
+                    "text": model.detokenize(sequence["generated"]).decode(
+                        "utf-8", errors="ignore"
+                    ),
+                    "prompt_tokens": sequence["prompt_tokens"],
+                    "completion_tokens": len(sequence["generated"]),
+                    "latency_s": round(perf_counter() - sequence["start_time"], 3),
+                    "error": None,
+                }
+                context.kv_cache_seq_rm(seq_id, -1, -1)
+                del active[seq_id]
+                free_slots.append(seq_id)
+                yield sequence["index"], result
+
@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+from diskcache import Cache
+
+CACHE_DIR = ".cache"
+
+
+def content_hash(*parts: str | bytes) -> str:
+    """
+    Function to build a content address (sha256) out of the provided parts
+
+    INPUT:
+        - parts -> strings or bytes that together identify a piece of content
+
+    OUTPUT:
+        - hex digest (str)
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        # Length prefix so ("ab", "c") and ("a", "bc") do not collide
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def file_hash(filepath: str) -> str:
+    """
+    Function to hash the bytes of a file on disk
+    """
+    with open(filepath, "rb") as file:
+        return content_hash(file.read())
+
+
+def open_cache(
+    name: str, size_limit: int, eviction_policy: str = "least-recently-used"
+) -> Cache:
+    """
+    Function to open (or create) a size bounded on-disk cache (least recently used entries evicted first by default)
+
+    INPUT:
+        - name -> Subdirectory of CACHE_DIR holding the cache
+        - size_limit -> Maximum size of the cache in bytes
+        - eviction_policy -> Which entries go first once the cache is full
+
+    OUTPUT:
+        - diskcache.Cache (safe to share between threads and processes)
+    """
+    return Cache(
+        os.path.join(CACHE_DIR, name),
+        size_limit=size_limit,
+        eviction_policy=eviction_policy,
+    )
+
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 2 * 1024**3))
+RESPONSE_CACHE_POLICY = os.environ.get("RESPONSE_CACHE_POLICY", "least-recently-used")
+
+
+def response_key(backend: str, model: str, messages: list | str, params: dict) -> str:
+    """
+    Function to build the key of an LLM response: backend, model, full messages and decoding parameters.
+    Local models pass their sampling seed in params, so a hit is the answer a rerun would produce. API
+    backends take no seed: their first sampled answer is frozen and replayed on every later hit.
+    """
+    return content_hash(
+        backend,
+        model,
+        json.dumps(messages, sort_keys=True, default=str),
+        json.dumps(params, sort_keys=True, default=str),
+    )
+
+
+def open_response_cache(
+    size_limit: int = RESPONSE_CACHE_SIZE, eviction_policy: str = RESPONSE_CACHE_POLICY
+) -> Cache:
+    """
+    Function to open the response cache shared by every backend
+
+    INPUT:
+        - size_limit -> Maximum size in bytes (RESPONSE_CACHE_SIZE environment variable by default)
+        - eviction_policy -> diskcache policy ("least-recently-used", "least-frequently-used",
+          "least-recently-stored" or "none"), RESPONSE_CACHE_POLICY environment variable by default
+    """
+    return open_cache("responses", size_limit, eviction_policy)
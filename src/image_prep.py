@@ -0,0 +1,86 @@
+import io
+import os
+from time import perf_counter
+from PIL import Image, ImageOps
+from .cache import content_hash, open_cache
+
+# Longest side sent to the model (0 sends the stored bytes unchanged) and JPEG quality
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", 1536))
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+IMAGE_CACHE_SIZE = 1024**3
+
+
+def open_image_cache():
+    """
+    Function to open the cache of prepared images (keyed by the source bytes and the preparation settings)
+    """
+    return open_cache("images", IMAGE_CACHE_SIZE)
+
+
+def reencode_image(image_bytes: bytes, max_side: int, quality: int) -> bytes:
+    """
+    Function to downscale an image to at most `max_side` pixels on its longest side and re-encode it as JPEG
+
+    Transparent areas are flattened on white and the EXIF orientation is applied before the metadata is dropped.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+
+def prepare_image(
+    image_bytes: bytes,
+    mime_type: str,
+    image_cache=None,
+    max_side: int = IMAGE_MAX_SIDE,
+    quality: int = IMAGE_QUALITY,
+) -> dict:
+    """
+    Function to get the bytes to upload for an image, re-encoded within the resolution/quality budget
+
+    INPUT:
+        - image_bytes, mime_type -> Image as stored on disk
+        - image_cache -> Cache of prepared images (open_image_cache() when None)
+        - max_side, quality -> Budget of the uploaded image (max_side 0 keeps the stored bytes)
+
+    OUTPUT:
+        - dict with "data", "mime_type", "image_bytes" (stored size), "upload_bytes", "prep_s" and "cache_hit"
+    """
+    start_time = perf_counter()
+    if max_side <= 0:
+        data, cache_hit = image_bytes, False
+    else:
+        own_cache = image_cache is None
+        image_cache = open_image_cache() if own_cache else image_cache
+        key = content_hash(image_bytes, str(max_side), str(quality))
+        data = image_cache.get(key)
+        cache_hit = data is not None
+        if not cache_hit:
+            data = reencode_image(image_bytes, max_side, quality)
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                fits = max(image.size) <= max_side
+            # Already within the budget and no smaller once re-encoded: sent as stored
+            if fits and len(data) >= len(image_bytes):
+                data = image_bytes
+            image_cache.set(key, data)
+        if own_cache:
+            image_cache.close()
+
+    return {
+        "data": data,
+        "mime_type": mime_type if data == image_bytes else "image/jpeg",
+        "image_bytes": len(image_bytes),
+        "upload_bytes": len(data),
+        "prep_s": round(perf_counter() - start_time, 4),
+        "cache_hit": cache_hit,
+    }
@@ -0,0 +1,141 @@
+import os
+import re
+import sys
+import time
+
+# Each literal is matched by a single pass over its characters (no nested quantifiers to backtrack on).
+# Inside a text block a quote is content unless it starts the last three quotes of a run, so content
+# ending in a quote (""" say "hi"""") closes on the final """
+_TEXT_BLOCK = re.compile(r'"""(?:[^"\\]|\\.|"(?!""(?!")))*(?:"""|\Z)', re.DOTALL)
+_STRING = re.compile(r'"(?:[^"\\\r\n]|\\.)*"?')
+_CHAR = re.compile(r"'(?:[^'\\\r\n]|\\.)*'?")
+_SPECIAL = re.compile(r"[/\"']")
+_LINE_END = re.compile(r"[\r\n]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def strip_comments(source: str) -> str:
+    """
+    Function to remove comments from Java code in one linear pass
+
+    Literals (strings, char literals and text blocks, including their escapes) are copied as they are,
+    so comment markers inside them are left alone. Unterminated literals and comments run to the end
+    of the line (or file) instead of swallowing the rest of the code. Block comments are replaced by a
+    space, as the JLS treats a comment as whitespace; line comments keep their line break.
+
+    INPUT :
+        - source -> code to be uncommented
+
+    OUTPUT :
+        - uncommented code (str)
+    """
+    pieces = []
+    kept_from = 0
+    position = 0
+    length = len(source)
+
+    while True:
+        special = _SPECIAL.search(source, position)
+        if special is None:
+            break
+        position = special.start()
+        character = source[position]
+
+        if character == "/":
+            following = source[position + 1 : position + 2]
+            if following == "/":
+                pieces.append(source[kept_from:position])
+                line_end = _LINE_END.search(source, position)
+                position = kept_from = line_end.start() if line_end else length
+            elif following == "*":
+                # A comment separates tokens like whitespace does (int/**/x is not intx)
+                pieces.append(source[kept_from:position])
+                pieces.append(" ")
+                comment_end = source.find("*/", position + 2)
+                position = kept_from = length if comment_end == -1 else comment_end + 2
+            else:
+                position += 1
+        elif character == '"':
+            literal = (
+                _TEXT_BLOCK.match(source, position)
+                if source.startswith('"""', position)
+                else _STRING.match(source, position)
+            )
+            position = literal.end() if literal else position + 1
+        else:
+            literal = _CHAR.match(source, position)
+            position = literal.end() if literal else position + 1
+
+    pieces.append(source[kept_from:])
+    return "".join(pieces)
+
+
+# Cases the lexer must get right, checked by benchmark() next to the corpus comparison
+EDGE_CASES = (
+    ('String s = "// not a comment"; // c\n', 'String s = "// not a comment"; \n'),
+    ('String s = "/* not */"; /* c */ int x;', 'String s = "/* not */";   int x;'),
+    ("int/**/x;", "int x;"),
+    ('String s = "a\\"b"; // c\n', 'String s = "a\\"b"; \n'),
+    ("char c = '\\''; // c\n", "char c = '\\''; \n"),
+    ("int x; // c\r\nint y;", "int x; \r\nint y;"),
+    ('String t = """\n a // b\n"""; // c\n', 'String t = """\n a // b\n"""; \n'),
+    ('String t = """\n say "hi""""; // c\n', 'String t = """\n say "hi""""; \n'),
+    ('String t = """\n q ""\\""""; // c\n', 'String t = """\n q ""\\""""; \n'),
+)
+
+
+def benchmark(corpus_path: str = "codes", repeats: int = 3) -> None:
+    """
+    Function to compare the lexer against the old regex based remove_comments over a corpus of Java files
+
+    INPUT:
+        - corpus_path -> Directory searched recursively for .java/.txt files
+        - repeats -> Number of timed passes over the corpus for each implementation
+    """
+    from .prompt_generation import remove_comments_regex
+
+    failed = [source for source, expected in EDGE_CASES if strip_comments(source) != expected]
+    print(f"Edge cases: {len(EDGE_CASES) - len(failed)}/{len(EDGE_CASES)} passed")
+    for source in failed:
+        print(f"  {source!r} -> {strip_comments(source)!r}")
+
+    sources = []
+    for root_path, dirs, files in os.walk(corpus_path):
+        dirs.sort()
+        for file in sorted(files):
+            if os.path.splitext(file)[1] in (".java", ".txt"):
+                with open(os.path.join(root_path, file), "r", errors="ignore") as code_file:
+                    sources.append((os.path.join(root_path, file), code_file.read()))
+
+    total_bytes = sum(len(source.encode("utf-8")) for _, source in sources)
+    print(f"Corpus: {len(sources)} files, {total_bytes / 1024 / 1024:.2f} MB")
+
+    for name, function in (
+        ("regex", remove_comments_regex),
+        ("lexer", strip_comments),
+    ):
+        best = float("inf")
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for _, source in sources:
+                function(source)
+            best = min(best, time.perf_counter() - start_time)
+        print(
+            f"{name:>6}: {best:.3f}s, {total_bytes / 1024 / 1024 / best:.2f} MB/s, "
+            f"{len(sources) / best:.0f} files/s"
+        )
+
+    # The regex drops block comments instead of leaving a space, so runs of whitespace are compared as one
+    different = [
+        filepath
+        for filepath, source in sources
+        if _WHITESPACE.sub(" ", remove_comments_regex(source))
+        != _WHITESPACE.sub(" ", strip_comments(source))
+    ]
+    print(f"Outputs differ for {len(different)}/{len(sources)} files")
+    for filepath in different[:20]:
+        print(f"  {filepath}")
+
+
+if __name__ == "__main__":
+    benchmark(*sys.argv[1:2])
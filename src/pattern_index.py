@@ -0,0 +1,145 @@
+import os
+import pickle
+import hashlib
+import xml.etree.ElementTree as ET
+from typing import Generator, Tuple
+
+PATTERN_LIST_PATH = "Design Pattern List v1.2.xml"
+SNAPSHOT_PATH = os.path.join(".cache", "pattern-index.pickle")
+INDEX_VERSION = 1
+
+
+def build_pattern_index(root: ET.Element) -> dict:
+    """
+    Function to walk the P-Mart XML tree once and build a compact index out of it
+
+    INPUT:
+        - root -> The root of the Element Tree containing the XML file data
+
+    OUTPUT:
+        - dict with the following keys
+            - occurrences -> list of (Project Name, pattern, role, entity FQCN) in document order
+            - projects -> Project Name -> pattern -> role -> list of entity FQCNs
+            - entities -> entity FQCN -> list of (Project Name, pattern, role)
+            - roles -> role -> list of entity FQCNs
+    """
+    occurrences = []
+    projects: dict[str, dict[str, dict[str, list[str]]]] = {}
+    entities: dict[str, list[Tuple[str, str, str]]] = {}
+    roles: dict[str, list[str]] = {}
+
+    for program in root:
+        project_name = None
+        for instance in program:
+            if instance.tag == "name":
+                project_name = str(instance.text)
+                projects.setdefault(project_name, {})
+                continue
+            if instance.attrib.get("name") is None:
+                continue
+            pattern_name = str(instance.attrib.get("name")).lower()
+            # Every entity sits directly below the element naming its role
+            for element in instance.iter():
+                for entity in element:
+                    if entity.tag != "entity":
+                        continue
+                    project_name = str(project_name)
+                    role, fqcn = element.tag, str(entity.text)
+                    occurrences.append((project_name, pattern_name, role, fqcn))
+                    projects.setdefault(project_name, {}).setdefault(
+                        pattern_name, {}
+                    ).setdefault(role, []).append(fqcn)
+                    entities.setdefault(fqcn, []).append(
+                        (project_name, pattern_name, role)
+                    )
+                    roles.setdefault(role, []).append(fqcn)
+
+    return {
+        "version": INDEX_VERSION,
+        "occurrences": occurrences,
+        "projects": projects,
+        "entities": entities,
+        "roles": roles,
+    }
+
+
+def load_pattern_index(
+    xml_path: str = PATTERN_LIST_PATH, snapshot_path: str | None = SNAPSHOT_PATH
+) -> dict:
+    """
+    Function to load the pattern index, parsing the XML file only when the binary snapshot is stale
+
+    INPUT:
+        - xml_path -> Path to the P-Mart design pattern list
+        - snapshot_path -> Where the pickled index is kept (None disables the snapshot)
+
+    OUTPUT:
+        - pattern index (dict), see build_pattern_index
+    """
+    with open(xml_path, "rb") as xml_file:
+        xml_data = xml_file.read()
+    source_hash = hashlib.sha256(xml_data).hexdigest()
+
+    if snapshot_path and os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, "rb") as snapshot_file:
+                index = pickle.load(snapshot_file)
+            if (
+                index.get("version") == INDEX_VERSION
+                and index.get("source_hash") == source_hash
+            ):
+                return index
+        except (pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"Ignoring unreadable index snapshot {snapshot_path}: {e}")
+
+    index = build_pattern_index(ET.fromstring(xml_data))
+    index["source_hash"] = source_hash
+
+    if snapshot_path:
+        os.makedirs(os.path.dirname(snapshot_path) or ".", exist_ok=True)
+        temp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as snapshot_file:
+            pickle.dump(index, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, snapshot_path)
+
+    return index
+
+
+def as_pattern_index(root_or_index: ET.Element | dict) -> dict:
+    """
+    Function to accept either an already built index or the raw XML root (older callers)
+    """
+    if isinstance(root_or_index, ET.Element):
+        return build_pattern_index(root_or_index)
+    assert (
+        isinstance(root_or_index, dict) and "occurrences" in root_or_index
+    ), "Provide the pattern index or the root of the XML file"
+    return root_or_index
+
+
+def iter_pattern_entities(
+    index: dict, pattern_name: str, roles: tuple
+) -> Generator[Tuple[str, str, str], None, None]:
+    """
+    Function to list the (Project Name, role, entity FQCN) of a pattern in document order
+    """
+    for project_name, pattern, role, fqcn in index["occurrences"]:
+        if pattern == pattern_name and role in roles:
+            yield project_name, role, fqcn
+
+
+def get_project_entities(
+    index: dict, project_name: str, pattern_name: str, roles: tuple
+) -> list[str]:
+    """
+    Function to list the entity FQCNs playing any of the roles of a pattern in one project
+    """
+    pattern_roles = index["projects"].get(project_name, {}).get(pattern_name, {})
+    return [fqcn for role in roles for fqcn in pattern_roles.get(role, [])]
+
+
+def get_role_entities(index: dict, role: str) -> set[str]:
+    """
+    Function to get every entity FQCN recorded for a role across all projects
+    """
+    return set(index["roles"].get(role, []))
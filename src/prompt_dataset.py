@@ -0,0 +1,209 @@
+import os
+import sys
+import sqlite3
+from .cache import content_hash
+
+DATASET_PATH = "prompts.sqlite"
+PROMPT_DIRECTORIES = ["prompts-code", "prompts-uml", "prompts-summary"]
+
+
+def connect_dataset(dataset_path: str = DATASET_PATH) -> sqlite3.Connection:
+    """
+    Function to open (or create) the packed prompt dataset
+
+    The dataset is a single SQLite file holding one row per prompt with its text, metadata and hashes.
+    WAL mode lets parallel generators write while the runners read, and reads are memory-mapped.
+    """
+    connection = sqlite3.connect(dataset_path, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA mmap_size=268435456")
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS prompts (
+            path TEXT PRIMARY KEY,
+            prompt_type INTEGER NOT NULL,
+            correctness TEXT NOT NULL,
+            pattern TEXT NOT NULL,
+            role TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            input_hash TEXT,
+            content_hash TEXT NOT NULL,
+            text TEXT NOT NULL
+        )
+        """
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS prompts_by_set ON prompts (prompt_type, correctness, pattern)"
+    )
+    return connection
+
+
+def prompt_path(
+    prompt_type: int, correct: bool, pattern: str, role: str, filename: str
+) -> str:
+    """
+    Function to build the path a prompt has in the directory layout (also its key in the dataset)
+    """
+    return os.path.join(
+        PROMPT_DIRECTORIES[prompt_type],
+        "correct" if correct else "incorrect",
+        pattern,
+        role,
+        filename,
+    )
+
+
+def read_input_hashes(
+    connection: sqlite3.Connection, prompt_type: int, correct: bool, pattern: str
+) -> dict[str, str]:
+    """
+    Function to read the input hashes of the stored prompts of a set (path -> input hash)
+    """
+    return dict(
+        connection.execute(
+            "SELECT path, input_hash FROM prompts WHERE prompt_type = ? AND correctness = ? AND pattern = ?",
+            (prompt_type, "correct" if correct else "incorrect", pattern),
+        )
+    )
+
+
+def write_prompt(
+    connection: sqlite3.Connection,
+    prompt_type: int,
+    correct: bool,
+    pattern: str,
+    role: str,
+    filename: str,
+    text: str,
+    input_hash: str | None = None,
+) -> None:
+    """
+    Function to insert or replace one prompt of the dataset
+    """
+    connection.execute(
+        "INSERT OR REPLACE INTO prompts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            prompt_path(prompt_type, correct, pattern, role, filename),
+            prompt_type,
+            "correct" if correct else "incorrect",
+            pattern,
+            role,
+            filename,
+            input_hash,
+            content_hash(text),
+            text,
+        ),
+    )
+
+
+def delete_prompts(connection: sqlite3.Connection, paths: list[str]) -> None:
+    """
+    Function to remove prompts from the dataset by path
+    """
+    connection.executemany("DELETE FROM prompts WHERE path = ?", [(path,) for path in paths])
+
+
+def prompt_sort_key(filename: str) -> tuple[int, int, str]:
+    """
+    Function to order prompt files by their hand-numbered prefix ("10 - Nutch v0.4 - Page.txt"),
+    generated names without one ("QuickUML 2001 - IconManager.txt") after them by name
+    """
+    prefix = filename[:2].strip()
+    if prefix.isdigit():
+        return 0, int(prefix), filename
+    return 1, 0, filename
+
+
+def load_prompts(
+    dataset_path: str, prompt_type: int, correct: bool, pattern: str
+) -> list[tuple[str, str, str, str]]:
+    """
+    Function to read the prompts of a set in one sequential query
+
+    OUTPUT:
+        - list of (role, prompt filename, prompt path, prompt text), ordered like the directory runners
+    """
+    connection = connect_dataset(dataset_path)
+    rows = connection.execute(
+        "SELECT role, filename, path, text FROM prompts WHERE prompt_type = ? AND correctness = ? AND pattern = ?",
+        (prompt_type, "correct" if correct else "incorrect", pattern),
+    ).fetchall()
+    connection.close()
+    return sorted(rows, key=lambda row: (row[0], prompt_sort_key(row[1])))
+
+
+def export_dataset(dataset_path: str = DATASET_PATH, output_root: str = ".") -> int:
+    """
+    Function to write the packed dataset back out in the prompts-*/correct|incorrect/<pattern>/<role>/ layout
+
+    OUTPUT:
+        - number of prompt files written
+    """
+    connection = connect_dataset(dataset_path)
+    written = 0
+    for path, text in connection.execute("SELECT path, text FROM prompts"):
+        output_path = os.path.join(output_root, path)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as prompt_file:
+            prompt_file.write(text)
+        written += 1
+    connection.close()
+    return written
+
+
+def import_prompt_directory(prompt_type: int, dataset_path: str = DATASET_PATH) -> int:
+    """
+    Function to pack an existing prompts-* directory tree into the dataset
+
+    OUTPUT:
+        - number of prompts packed
+    """
+    connection = connect_dataset(dataset_path)
+    packed = 0
+    prompt_root = PROMPT_DIRECTORIES[prompt_type]
+    with connection:
+        for correctness in ("correct", "incorrect"):
+            correctness_path = os.path.join(prompt_root, correctness)
+            if not os.path.isdir(correctness_path):
+                continue
+            for pattern in os.listdir(correctness_path):
+                pattern_path = os.path.join(correctness_path, pattern)
+                for role in os.listdir(pattern_path):
+                    role_path = os.path.join(pattern_path, role)
+                    for filename in os.listdir(role_path):
+                        with open(os.path.join(role_path, filename), "r") as prompt_file:
+                            text = prompt_file.read()
+                        write_prompt(
+                            connection,
+                            prompt_type,
+                            correctness == "correct",
+                            pattern,
+                            role,
+                            filename,
+                            text,
+                        )
+                        packed += 1
+    connection.close()
+    return packed
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    dataset_path = sys.argv[2] if len(sys.argv) > 2 else DATASET_PATH
+
+    if command == "export":
+        print(f"Exported {export_dataset(dataset_path)} prompts from {dataset_path}")
+    elif command == "import":
+        for prompt_type in range(len(PROMPT_DIRECTORIES)):
+            print(
+                f"Packed {import_prompt_directory(prompt_type, dataset_path)} prompts "
+                f"from {PROMPT_DIRECTORIES[prompt_type]}"
+            )
+    else:
+        print("Usage: python -m src.prompt_dataset (export|import) [dataset path]")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,94 @@
 import os
 import re
+import json
 import random
+import time
+import argparse
 import subprocess
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import xml.etree.ElementTree as ET
 from typing import Generator, Tuple
+from .cache import content_hash, open_cache
+from .java_lexer import strip_comments
+from .prompt_dataset import (
+    connect_dataset,
+    delete_prompts,
+    read_input_hashes,
+    write_prompt,
+)
+from .pattern_index import (
+    as_pattern_index,
+    get_project_entities,
+    iter_pattern_entities,
+    load_pattern_index,
+)
+
+SEED = 42
+
+pattern_element_map = {
+    "singleton": ("singleton",),
+    "adapter": ("adapter",),
+    "decorator": ("decorator", "concreteDecorator"),
+    "facade": ("facade",),
+    "flyweight": ("flyweight",),
+    "bridge": ("abstraction", "implementor"),
+    "composite": ("component", "composite", "leaf"),
+    "proxy": ("proxy", "subject"),
+}
+
+
+PLANTUML_JAR = "plantumlparsergit/plantuml-parser/plantuml-parser-cli/build/libs/plantuml-parser-cli-0.0.1-all.jar"
+PLANTUML_FLAGS = (
+    "-l",
+    "JAVA_17",
+    "-sctr",
+    "-spkg",
+    "-fpub",
+    "-mpub",
+    "-fpro",
+    "-mpro",
+    "-fpri",
+    "-mpri",
+    "-fdef",
+    "-mdef",
+)
+# Short lived JVMs spend most of their time starting up, so skip the optimising JIT
+PLANTUML_JVM_OPTIONS = ("-XX:TieredStopAtLevel=1", "-XX:+UseSerialGC", "-Xshare:auto")
+
+# Bump whenever remove_comments changes its output so cached stripped code is not reused
+REMOVE_COMMENTS_VERSION = "lexer-3"
+ARTIFACT_CACHE_SIZE = 512 * 1024 * 1024
+_artifact_cache = None
+
+
+def get_artifact_cache():
+    """
+    Function to open the cache of generated PlantUML and uncommented code (once per process)
+    """
+    global _artifact_cache
+    if _artifact_cache is None:
+        _artifact_cache = open_cache("artifacts", ARTIFACT_CACHE_SIZE)
+    return _artifact_cache
 
-random.seed(42)
 
+def plantuml_version() -> str:
+    """
+    Function to identify the parser build and flags the PlantUML output depends on
+    """
+    jar_stat = os.stat(PLANTUML_JAR) if os.path.exists(PLANTUML_JAR) else None
+    return content_hash(
+        PLANTUML_JAR,
+        str(jar_stat.st_size if jar_stat else None),
+        str(jar_stat.st_mtime_ns if jar_stat else None),
+        *PLANTUML_FLAGS,
+    )
 
-def generate_plantuml_syntax(java_filepath: str):
-    """Generates the plantuml syntax for a Java file"""
-    # print(java_filepath)
-    # if "PMD" in java_filepath:
-    #     java_filepath = java_filepath.replace(
-    #         "/net/", "/out/production/11 - PMD v1.8/net/"
-    #     )
 
+def resolve_java_filepath(java_filepath: str) -> str:
+    """
+    Function to find the Java file that holds a class (inner classes live in their parent's file)
+    """
     if not os.path.exists(java_filepath):
         parent_dir = os.path.dirname(java_filepath)
         if os.path.exists(parent_dir + ".java"):
@@ -27,57 +100,165 @@ def generate_plantuml_syntax(java_filepath: str):
             )
 
     assert os.path.splitext(java_filepath)[1] == ".java", "File extension incorrect"
+    return java_filepath
+
+
+def generate_plantuml_syntax(java_filepath: str):
+    """Generates the plantuml syntax for a Java file"""
+    java_filepath = resolve_java_filepath(java_filepath)
 
     # Run plantuml-parser-cli
+    start_time = time.perf_counter()
     plantuml_result = subprocess.run(
-        [
-            "java",
-            "-jar",
-            "plantumlparsergit/plantuml-parser/plantuml-parser-cli/build/libs/plantuml-parser-cli-0.0.1-all.jar",
-            "-l",
-            "JAVA_17",
-            "-f",
-            java_filepath,
-            "-sctr",
-            "-spkg",
-            "-fpub",
-            "-mpub",
-            "-fpro",
-            "-mpro",
-            "-fpri",
-            "-mpri",
-            "-fdef",
-            "-mdef",
-        ],
+        ["java", "-jar", PLANTUML_JAR, "-f", java_filepath, *PLANTUML_FLAGS],
         capture_output=True,
         text=True,
     )
 
     print(plantuml_result)
-    # # Run genuml
-    # genuml_result = subprocess.run(
-    #     ["genuml", "generate", java_filepath],
-    #     capture_output=True,
-    #     text=True,
-    # )
+    print(f"PlantUML generated in {time.perf_counter() - start_time:.2f}s")
     return plantuml_result.stdout
 
 
+def generate_plantuml_batch(
+    java_filepaths: list[str], workers: int | None = None, use_cache: bool = True
+) -> dict[str, str | Exception]:
+    """
+    Function to generate the plantuml syntax for many Java files using a small pool of parser processes
+
+    INPUT:
+        - java_filepaths -> Java files to parse
+        - workers -> Number of parser processes kept running at once (default: half the CPUs, at most 8)
+        - use_cache -> Whether to reuse PlantUML generated earlier for the same file content
+
+    OUTPUT:
+        - dict of Java filepath -> plantuml syntax, or the exception raised for that file
+    """
+    if workers is None:
+        workers = max(1, min(8, (os.cpu_count() or 2) // 2))
+
+    def _parse(java_filepath: str) -> str:
+        resolved_filepath = resolve_java_filepath(java_filepath)
+        print(f"Generating PlantUML for {resolved_filepath}")
+        plantuml_result = subprocess.run(
+            [
+                "java",
+                *PLANTUML_JVM_OPTIONS,
+                "-jar",
+                PLANTUML_JAR,
+                "-f",
+                resolved_filepath,
+                *PLANTUML_FLAGS,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if plantuml_result.returncode != 0:
+            raise RuntimeError(
+                f"plantuml-parser-cli exited with {plantuml_result.returncode} "
+                f"for {resolved_filepath}: {plantuml_result.stderr.strip()}"
+            )
+        return plantuml_result.stdout
+
+    results: dict[str, str | Exception] = {}
+    unique_filepaths = list(dict.fromkeys(java_filepaths))
+    start_time = time.perf_counter()
+
+    # Files whose content was parsed before by the same parser build come from the cache
+    artifact_cache = get_artifact_cache() if use_cache else None
+    parser_version = plantuml_version()
+    cache_keys = {}
+    for java_filepath in unique_filepaths:
+        try:
+            resolved_filepath = resolve_java_filepath(java_filepath)
+            with open(resolved_filepath, "rb") as java_file:
+                cache_keys[java_filepath] = content_hash(
+                    "plantuml", parser_version, java_file.read()
+                )
+        except Exception as e:
+            results[java_filepath] = e
+            continue
+        if artifact_cache is not None:
+            cached_output = artifact_cache.get(cache_keys[java_filepath])
+            if cached_output is not None:
+                results[java_filepath] = cached_output
+    cache_hits = sum(isinstance(result, str) for result in results.values())
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_parse, java_filepath): java_filepath
+            for java_filepath in unique_filepaths
+            if java_filepath not in results
+        }
+        for future in as_completed(futures):
+            java_filepath = futures[future]
+            # Failures stay with the file that caused them
+            try:
+                results[java_filepath] = future.result()
+            except Exception as e:
+                results[java_filepath] = e
+                continue
+            if artifact_cache is not None:
+                artifact_cache.set(cache_keys[java_filepath], results[java_filepath])
+
+    elapsed = time.perf_counter() - start_time
+    failed = sum(isinstance(result, Exception) for result in results.values())
+    if unique_filepaths:
+        print(
+            f"PlantUML batch: {len(unique_filepaths)} files ({cache_hits} cached, {failed} failed) "
+            f"in {elapsed:.2f}s with {workers} workers, {elapsed / len(unique_filepaths):.2f}s/file"
+        )
+    return results
+
+
+def remove_comments_cached(code: str) -> str:
+    """
+    Function to remove comments from code, reusing the stripped code of previously seen content
+    """
+    artifact_cache = get_artifact_cache()
+    cache_key = content_hash("uncommented", REMOVE_COMMENTS_VERSION, code)
+    uncommented_code = artifact_cache.get(cache_key)
+    if uncommented_code is None:
+        uncommented_code = remove_comments(code)
+        artifact_cache.set(cache_key, uncommented_code)
+    return uncommented_code
+
+
+def derive_seed(seed: int, pattern_name: str, wrong: bool, prompt_type: int) -> int:
+    """
+    Function to derive the seed of the random stream used by one (pattern, correctness, prompt type)
+    """
+    return int(
+        content_hash(str(seed), pattern_name, str(wrong), str(prompt_type))[:16], 16
+    )
+
+
 def generate_prompt_files(
-    root: ET.Element,
+    index: dict | ET.Element,
     pattern_name: str,
     wrong: bool,
     just_code: bool,
     prompt_type: int = 0,
+    seed: int = SEED,
+    plantuml_workers: int | None = None,
+    unique_negatives: bool = False,
+    dataset_path: str | None = None,
 ) -> None:
     """
     Function to generate all the prompt files of the provided pattern (pattern_name).
 
     INPUT:
-        - root -> The root of the Element Tree containing the XML file data
+        - index -> The pattern index (see pattern_index.load_pattern_index)
         - pattern_name -> The name of the pattern to generate prompts for
         - wrong -> Whether to create incorrect dataset as well
+        - seed -> Base seed, every (pattern, correctness, prompt type) draws from its own stream
+        - plantuml_workers -> Number of PlantUML parser processes (see generate_plantuml_batch)
+        - unique_negatives -> Whether an incorrect file may only be drawn once per project
+        - dataset_path -> Packed dataset to write the prompts into instead of separate files
     """
+    assert not (just_code and dataset_path), "Codes can only be written as files"
+    index = as_pattern_index(index)
+    rng = random.Random(derive_seed(seed, pattern_name, wrong, prompt_type))
     if just_code:
         prompt_output_path = "./codes"
     else:
@@ -89,8 +270,9 @@ def generate_prompt_files(
         base_prompt = base_prompt_file.read()
 
     # Accessing the Project Names and the filepaths containing the pattern implementation
+    prompt_jobs = {}
     for project_name, element_role, rel_filepath, package_name in pattern_finder(
-        root, pattern_name, wrong
+        index, pattern_name, wrong, rng, unique_negatives
     ):
         print(project_name, element_role, rel_filepath)
         # Check if pattern_name and element_role subfolders are present
@@ -100,162 +282,268 @@ def generate_prompt_files(
             pattern_name,
             element_role,
         )
-        if not os.path.exists(prompt_file_location):
-            os.makedirs(prompt_file_location)
+        if dataset_path is None and not os.path.exists(prompt_file_location):
+            os.makedirs(prompt_file_location, exist_ok=True)
 
         # Generating the prompt output file path
-        prompt_filepath = os.path.join(
-            prompt_file_location,
-            f"{project_name} - {os.path.basename(rel_filepath)}.txt",
+        prompt_filepath = os.path.normpath(
+            os.path.join(
+                prompt_file_location,
+                f"{project_name} - {os.path.basename(rel_filepath)}.txt",
+            )
         )
-        try:
+        prompt_jobs[prompt_filepath] = (
+            element_role,
+            find_source_filepath(project_name, rel_filepath),
+            package_name,
+        )
+
+    # Only prompts whose inputs changed since the last run are regenerated
+    manifest_path = os.path.join(
+        prompt_output_path,
+        ".manifests",
+        f"{'incorrect' if wrong else 'correct'}-{pattern_name}-{prompt_type}.json",
+    )
+    if dataset_path is None:
+        previous_manifest = load_manifest(manifest_path)
+    else:
+        # The packed dataset stores the input hash next to every prompt
+        dataset = connect_dataset(dataset_path)
+        previous_manifest = read_input_hashes(
+            dataset, prompt_type, not wrong, pattern_name
+        )
+    manifest = {}
+    stale_jobs = []
+    for prompt_filepath, (element_role, source_filepath, package_name) in prompt_jobs.items():
+        input_hash = prompt_input_hash(
+            base_prompt,
+            pattern_name,
+            element_role,
+            prompt_type,
+            just_code,
+            source_filepath,
+            package_name,
+        )
+        if previous_manifest.get(prompt_filepath) == input_hash and (
+            dataset_path is not None or os.path.exists(prompt_filepath)
+        ):
+            manifest[prompt_filepath] = input_hash
+        else:
+            stale_jobs.append(
+                (element_role, prompt_filepath, source_filepath, package_name, input_hash)
+            )
+
+    # All the UML diagrams are generated up front so the parser processes can be shared
+    plantuml_outputs = {}
+    if prompt_type == 1:
+        plantuml_outputs = generate_plantuml_batch(
+            [
+                source_filepath + ".java"
+                for _, _, source_filepath, _, _ in stale_jobs
+                if source_filepath is not None
+            ],
+            workers=plantuml_workers,
+        )
+
+    for (
+        element_role,
+        prompt_filepath,
+        source_filepath,
+        package_name,
+        input_hash,
+    ) in stale_jobs:
+        if source_filepath is None:
+            # Source file missing, so the prompt only carries the package name
+            code = uncommented_code = package_name
+        else:
             # Reading the code from the source code file
-            code = None
-            # print(rel_filepath)
-            if "beans" in project_name:
-                print(3)
-                print(rel_filepath)
-                if rel_filepath.startswith("org"):
-                    rel_filepath += "src" + os.path.sep
-                    print(rel_filepath)
-            print(rel_filepath)
-            if not os.path.exists(rel_filepath + ".java"):
-                print(1)
-                parent_dir = os.path.dirname(rel_filepath)
-                print(parent_dir)
-                if os.path.exists(parent_dir + ".java"):
-                    print(2)
-                    rel_filepath = parent_dir
-                    print(f"Changing filepath to {rel_filepath}")
-                else:
-                    raise FileNotFoundError(
-                        f"Neither {rel_filepath} nor its parent directory exists."
-                    )
             if prompt_type == 0:
-                with open(f"{rel_filepath}.java", "r", errors="ignore") as code_file:
+                with open(
+                    f"{source_filepath}.java", "r", errors="ignore"
+                ) as code_file:
                     code = code_file.read()
             elif prompt_type == 1:
-                # rel_filepath = rel_filepath.replace("/src/", "/bin/")
-                code = generate_plantuml_syntax(rel_filepath + ".java")
+                code = plantuml_outputs[source_filepath + ".java"]
+                if isinstance(code, Exception):
+                    print(f"Skipping {prompt_filepath}: {code}")
+                    continue
             else:
                 code = "WOW"
 
-            uncommented_code = remove_comments(code)
+            uncommented_code = remove_comments_cached(code)
 
-            # Writing formatted prompt to the output file
-            with open(prompt_filepath, "w") as prompt_file:
-                if just_code:
-                    prompt_file.write(code)
-                else:
-                    prompt_file.write(
-                        base_prompt.format(
-                            code=uncommented_code,
-                            role=element_role,
-                            pattern=pattern_name,
-                            type="java" if prompt_type == 0 else "uml",
-                        )
-                    )
-        except FileNotFoundError:
-            # Writing formatted prompt to the output file
+        if just_code:
+            prompt_text = code
+        else:
+            prompt_text = base_prompt.format(
+                code=uncommented_code,
+                role=element_role,
+                pattern=pattern_name,
+                type="java" if prompt_type == 0 else "uml",
+            )
+
+        # Writing formatted prompt to the output file (or dataset)
+        if dataset_path is None:
             with open(prompt_filepath, "w") as prompt_file:
-                if just_code:
-                    prompt_file.write(package_name)
-                else:
-                    prompt_file.write(
-                        base_prompt.format(
-                            code=package_name,
-                            role=element_role,
-                            pattern=pattern_name,
-                            type="java" if prompt_type == 0 else "uml",
-                        )
-                    )
+                prompt_file.write(prompt_text)
+        else:
+            write_prompt(
+                dataset,
+                prompt_type,
+                not wrong,
+                pattern_name,
+                element_role,
+                os.path.basename(prompt_filepath),
+                prompt_text,
+                input_hash,
+            )
+        manifest[prompt_filepath] = input_hash
+
+    # Prompts generated by an earlier run that are no longer part of the dataset
+    orphaned_filepaths = [
+        prompt_filepath
+        for prompt_filepath in previous_manifest
+        if prompt_filepath not in prompt_jobs
+    ]
+    if dataset_path is None:
+        for prompt_filepath in orphaned_filepaths:
+            if os.path.exists(prompt_filepath):
+                os.remove(prompt_filepath)
+        save_manifest(manifest_path, manifest)
+    else:
+        delete_prompts(dataset, orphaned_filepaths)
+        dataset.commit()
+        dataset.close()
+    print(
+        f"{pattern_name} ({'incorrect' if wrong else 'correct'}, prompt {prompt_type}): "
+        f"{len(prompt_jobs) - len(stale_jobs)} unchanged, {len(stale_jobs)} regenerated, "
+        f"{len(orphaned_filepaths)} removed"
+    )
+
+
+def prompt_input_hash(
+    base_prompt: str,
+    pattern_name: str,
+    element_role: str,
+    prompt_type: int,
+    just_code: bool,
+    source_filepath: str | None,
+    package_name: str,
+) -> str:
+    """
+    Function to hash everything a generated prompt file depends on
+    """
+    if source_filepath is None:
+        source = package_name.encode("utf-8")
+    else:
+        with open(f"{source_filepath}.java", "rb") as source_file:
+            source = source_file.read()
+    return content_hash(
+        base_prompt,
+        pattern_name,
+        element_role,
+        str(prompt_type),
+        str(just_code),
+        str(source_filepath is None),
+        source,
+        REMOVE_COMMENTS_VERSION,
+        plantuml_version() if prompt_type == 1 else "",
+    )
+
+
+def load_manifest(manifest_path: str) -> dict[str, str]:
+    """
+    Function to load the build manifest (prompt filepath -> input hash) of an earlier run
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+    except json.JSONDecodeError as e:
+        print(f"Ignoring unreadable manifest {manifest_path}: {e}")
+        return {}
+
+
+def save_manifest(manifest_path: str, manifest: dict[str, str]) -> None:
+    """
+    Function to atomically store the build manifest of the current run
+    """
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    temp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def find_source_filepath(project_name: str, rel_filepath: str) -> str | None:
+    """
+    Function to locate the source file (without extension) of an entity, None if it is missing
+    """
+    if "beans" in project_name and rel_filepath.startswith("org"):
+        rel_filepath += "src" + os.path.sep
+    if os.path.exists(rel_filepath + ".java"):
+        return rel_filepath
+
+    # Inner classes are stored in the file of their parent class
+    parent_dir = os.path.dirname(rel_filepath)
+    if os.path.exists(parent_dir + ".java"):
+        print(f"Changing filepath to {parent_dir}")
+        return parent_dir
+    return None
 
 
 def pattern_finder(
-    root: ET.Element, pattern_name: str, wrong: bool
+    index: dict | ET.Element,
+    pattern_name: str,
+    wrong: bool,
+    rng: random.Random | None = None,
+    unique_negatives: bool = False,
 ) -> Generator[Tuple[str, str, str, str], None, None]:
     """
     Function to find the pattern instances from the source codes according to the provided file
 
     INPUT:
-        - root -> The root of the Element Tree containing the XML file data
+        - index -> The pattern index (see pattern_index.load_pattern_index)
         - pattern_name -> The name of the pattern to search
         - wrong -> Whether to create incorrect dataset as well
+        - rng -> Random stream used for the incorrect dataset (default: the global one)
+        - unique_negatives -> Whether an incorrect file may only be drawn once per project
 
     OUTPUT:
         - list of tuples (Project Name, Path to the file)
     """
-    pattern_element_map = {
-        "singleton": ("singleton",),
-        "adapter": ("adapter",),
-        "decorator": ("decorator", "concreteDecorator"),
-        "facade": ("facade",),
-        "flyweight": ("flyweight",),
-        "bridge": ("abstraction", "implementor"),
-        "composite": ("component", "composite", "leaf"),
-        "proxy": ("proxy", "subject"),
-    }
-
-    assert type(root) == ET.Element, f"Provide the root of the XML file"
+    index = as_pattern_index(index)
+    rng = rng if rng is not None else random
     assert (
         pattern_name in pattern_element_map.keys()
     ), f"{pattern_name} is not supported yet"
 
-    # Extract pattern instances from the XML file by searching for correct stuff
-    for program in root:
-        project_name = None
-        for instance in program:
-            if instance.tag == "name":
-                project_name = instance.text
-            if str(instance.attrib.get("name")).lower() == pattern_name:
-                for element in instance.iter():
-                    if element.tag in pattern_element_map[pattern_name]:
-                        for entity in element.iter():
-                            if entity.tag == "entity":
-                                # print(
-                                #     "{:<30} - {:>10} - {:>10}".format(
-                                #         project_name, element.tag, entity.text
-                                #     )
-                                # )
-                                rel_filepath = None
-                                package_name = entity.text
-                                if wrong and project_name in os.listdir("source-codes"):
-                                    while True:
-                                        random_pattern = random.choice(
-                                            list(pattern_element_map.keys())
-                                        )
-
-                                        if random_pattern != pattern_name:
-                                            break
-
-                                    # project_names = os.listdir("source-codes")
-                                    # project_names.remove(project_name)
-                                    while True:
-                                        # print(project_name)
-                                        rel_filepath = get_random_filepath(
-                                            root,
-                                            str(project_name),
-                                            pattern_name,
-                                            pattern_element_map[pattern_name],
-                                        )
-
-                                        package_name = ".".join(
-                                            rel_filepath.split(os.path.sep)[3:]
-                                        )
-                                        # Check whether incorrect file got generated
-                                        if rel_filepath and check_randomness(
-                                            str(rel_filepath), root.iter(pattern_name)
-                                        ):
-                                            break
-                                else:
-                                    rel_filepath = get_pattern_filepath(
-                                        str(project_name), str(entity.text)
-                                    )
-                                # print(rel_filepath)
-                                if rel_filepath:
-                                    yield str(project_name), str(element.tag), str(
-                                        rel_filepath
-                                    ), str(package_name)
+    available_projects = (
+        set(os.listdir("source-codes")) if os.path.isdir("source-codes") else set()
+    )
+    negative_sampler = NegativeSampler(
+        index, pattern_name, rng, replacement=not unique_negatives
+    )
+
+    # Extract pattern instances from the index by searching for correct stuff
+    for project_name, element_role, entity_name in iter_pattern_entities(
+        index, pattern_name, pattern_element_map[pattern_name]
+    ):
+        rel_filepath = None
+        package_name = entity_name
+        if wrong and project_name in available_projects:
+            rel_filepath = negative_sampler.draw(str(project_name))
+            if rel_filepath is None:
+                print(f"No incorrect files left to draw in {project_name}")
+                continue
+            package_name = ".".join(rel_filepath.split(os.path.sep)[3:])
+        else:
+            rel_filepath = get_pattern_filepath(str(project_name), str(entity_name))
+        if rel_filepath:
+            yield str(project_name), str(element_role), str(rel_filepath), str(
+                package_name
+            )
 
 
 def get_pattern_filepath(project_name: str, filename: str) -> str | None:
@@ -283,7 +571,20 @@ def get_pattern_filepath(project_name: str, filename: str) -> str | None:
 
 def remove_comments(string: str) -> str:
     """
-    Function to remove comments from a provided string (using regex)
+    Function to remove comments from a provided string (using a single pass Java lexer)
+
+    INPUT :
+        - string -> code to be uncommented
+
+    OUTPUT :
+        - uncommented code (str)
+    """
+    return strip_comments(string)
+
+
+def remove_comments_regex(string: str) -> str:
+    """
+    Function to remove comments from a provided string (using regex, kept for comparison)
 
     INPUT :
         - string -> code to be uncommented
@@ -308,62 +609,235 @@ def remove_comments(string: str) -> str:
     return regex.sub(_replacer, string)
 
 
-def get_random_filepath(
-    root: ET.Element,
-    project_name: str,
-    pattern_name: str,
-    possible_elements: tuple,
-) -> str:
-    random_file_choices = []
+@lru_cache(maxsize=None)
+def list_project_java_files(project_name: str) -> tuple[str, ...]:
+    """
+    Function to list the Java files (without extension) of a project once per process
+    """
+    java_filepaths = []
     source_filepath = os.path.join("source-codes", project_name)
     if "PMD" not in project_name:
         source_filepath = os.path.join(source_filepath, "src")
     else:
         source_filepath = os.path.join(source_filepath, "net")
     for root_path, dirs, files in os.walk(source_filepath):
-        if files != []:
-            for file in files:
-                if "java" in os.path.splitext(file)[1]:
-                    random_file_choices.append(
-                        os.path.join(root_path, os.path.splitext(file)[0])
-                    )
-
-    program_found = False
-    random_file_choice = None
-    while not program_found:
-        random_file_choice = str(random.choice(random_file_choices))
-        # print(random_file_choice)
-
-        for program in root:
-            for instance in program:
-                if instance.tag == "name" and instance.text == project_name:
-                    for instance in program:
-                        if str(instance.attrib.get("name")).lower() == pattern_name:
-                            for element in instance.iter():
-                                if element.tag in possible_elements:
-                                    for entity in element.iter():
-                                        if entity.tag == "entity":
-                                            if (
-                                                get_pattern_filepath(
-                                                    project_name, str(entity.text)
-                                                )
-                                                != random_file_choice
-                                            ):
-                                                program_found = True
-
-    return str(random_file_choice)
-
-
-def check_randomness(
-    filepath: str, pattern_instances: Generator[ET.Element, None, None]
-) -> bool:
-    """
-    Function to check if the random filepath generated is not an instance of the provided pattern_instances
-    """
-    for pattern_instance in pattern_instances:
-        # print(pattern_instance)
-        for entity in pattern_instance.iter("entity"):
-            if entity.text == filepath:
-                return False
-
-    return True
+        # Walk in a fixed order so the draws do not depend on the filesystem
+        dirs.sort()
+        for file in sorted(files):
+            if "java" in os.path.splitext(file)[1]:
+                java_filepaths.append(os.path.join(root_path, os.path.splitext(file)[0]))
+    return tuple(java_filepaths)
+
+
+class NegativeSampler:
+    """
+    Draws incorrect files for a pattern from per-project candidate lists with the known positives removed.
+    Every draw takes constant time and returns None once a project has nothing left to offer.
+    """
+
+    def __init__(
+        self,
+        index: dict,
+        pattern_name: str,
+        rng: random.Random | None = None,
+        replacement: bool = True,
+    ):
+        self.index = index
+        self.pattern_name = pattern_name
+        self.rng = rng if rng is not None else random
+        self.replacement = replacement
+        self._candidates: dict[str, list[str]] = {}
+
+    def positives(self, project_name: str) -> set[str]:
+        """
+        Filepaths of the entities playing a role of the pattern in a project (and the files holding them)
+        """
+        positive_filepaths = set()
+        for entity_name in get_project_entities(
+            self.index,
+            project_name,
+            self.pattern_name,
+            pattern_element_map[self.pattern_name],
+        ):
+            pattern_filepath = str(get_pattern_filepath(project_name, entity_name))
+            # Inner classes live in the file of their parent class
+            positive_filepaths.update(
+                (pattern_filepath, os.path.dirname(pattern_filepath))
+            )
+        return positive_filepaths
+
+    def candidates(self, project_name: str) -> list[str]:
+        """
+        Filepaths that may still be drawn for a project
+        """
+        if project_name not in self._candidates:
+            positive_filepaths = self.positives(project_name)
+            self._candidates[project_name] = [
+                java_filepath
+                for java_filepath in list_project_java_files(project_name)
+                if check_randomness(java_filepath, positive_filepaths)
+            ]
+        return self._candidates[project_name]
+
+    def draw(self, project_name: str) -> str | None:
+        """
+        Draw one incorrect filepath of a project (None when there is none left)
+        """
+        candidates = self.candidates(project_name)
+        if not candidates:
+            return None
+        position = self.rng.randrange(len(candidates))
+        random_file_choice = candidates[position]
+        if not self.replacement:
+            # Swap with the last candidate so removal stays constant time
+            candidates[position] = candidates[-1]
+            candidates.pop()
+        return random_file_choice
+
+
+def get_random_filepath(
+    index: dict | ET.Element,
+    project_name: str,
+    pattern_name: str,
+    possible_elements: tuple,
+    rng: random.Random | None = None,
+) -> str | None:
+    """
+    Function to draw one file of a project that does not play a role of the pattern (None if there is none)
+    """
+    assert possible_elements == pattern_element_map[pattern_name], "Roles not supported"
+    return NegativeSampler(as_pattern_index(index), pattern_name, rng).draw(
+        project_name
+    )
+
+
+def check_randomness(filepath: str, positive_filepaths: set[str]) -> bool:
+    """
+    Function to check if the random filepath generated is not one of the provided positive filepaths
+    """
+    return filepath not in positive_filepaths
+
+
+def generate_all_prompt_files(
+    index: dict | ET.Element | None = None,
+    patterns: tuple = tuple(pattern_element_map.keys()),
+    prompt_types: tuple = (0, 1),
+    workers: int | None = None,
+    seed: int = SEED,
+    unique_negatives: bool = False,
+    dataset_path: str | None = None,
+) -> None:
+    """
+    Function to generate the prompt files of every (pattern, correctness, prompt type) combination in parallel.
+    Every combination draws from its own seeded stream, so the output does not depend on workers or ordering.
+
+    INPUT:
+        - index -> The pattern index (loaded from the default XML file when not provided)
+        - patterns -> Patterns to generate prompts for
+        - prompt_types -> Prompt types to generate (0 = code, 1 = uml, 2 = summary, whose code is still a
+          placeholder and so only generated on request)
+        - workers -> Number of processes (default: one per CPU)
+        - seed -> Base seed for the incorrect dataset
+        - unique_negatives -> Whether an incorrect file may only be drawn once per project
+        - dataset_path -> Packed dataset to write the prompts into instead of separate files
+    """
+    index = load_pattern_index() if index is None else as_pattern_index(index)
+    combinations = [
+        (pattern_name, wrong, prompt_type)
+        for pattern_name in patterns
+        for wrong in (False, True)
+        for prompt_type in prompt_types
+    ]
+    workers = workers or os.cpu_count() or 1
+    # Share the CPUs between the parser pools of concurrently running combinations
+    plantuml_workers = max(1, (os.cpu_count() or 2) // (2 * workers))
+
+    start_time = time.perf_counter()
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                generate_prompt_files,
+                index,
+                pattern_name,
+                wrong,
+                False,
+                prompt_type,
+                seed,
+                plantuml_workers,
+                unique_negatives,
+                dataset_path,
+            ): (pattern_name, wrong, prompt_type)
+            for pattern_name, wrong, prompt_type in combinations
+        }
+        for future in as_completed(futures):
+            pattern_name, wrong, prompt_type = futures[future]
+            try:
+                future.result()
+                print(
+                    f"Generated {pattern_name} ({'incorrect' if wrong else 'correct'}, prompt {prompt_type})"
+                )
+            except Exception as e:
+                failures.append(futures[future])
+                print(
+                    f"Failed {pattern_name} ({'incorrect' if wrong else 'correct'}, prompt {prompt_type}): {e}"
+                )
+
+    print(
+        f"Generated {len(combinations) - len(failures)}/{len(combinations)} combinations "
+        f"in {time.perf_counter() - start_time:.2f}s with {workers} workers"
+    )
+
+
+def main():
+    # Create Parser
+    parser = argparse.ArgumentParser(description="Generate the prompt files")
+
+    # Arguments
+    parser.add_argument(
+        "--patterns",
+        nargs="+",
+        default=list(pattern_element_map.keys()),
+        help="Patterns to generate prompts for",
+    )
+    parser.add_argument(
+        "--prompts",
+        nargs="+",
+        type=int,
+        default=[0, 1],
+        help="Prompt types (2 = summary, still a placeholder, only on request)",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes")
+    parser.add_argument("--seed", type=int, default=SEED, help="Base random seed")
+    parser.add_argument(
+        "--unique-negatives",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Draw every incorrect file at most once per project",
+    )
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default=None,
+        help="Write the prompts into this packed dataset instead of separate files",
+    )
+
+    args = parser.parse_args()
+
+    assert all(
+        pattern in pattern_element_map for pattern in args.patterns
+    ), "Pattern not supported..."
+    assert all(0 <= prompt <= 2 for prompt in args.prompts), "Prompt type not valid..."
+
+    generate_all_prompt_files(
+        patterns=tuple(args.patterns),
+        prompt_types=tuple(args.prompts),
+        workers=args.workers,
+        seed=args.seed,
+        unique_negatives=args.unique_negatives,
+        dataset_path=args.dataset,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at `per_minute` units per minute, holding at most one minute worth.
+    Reservations may overdraw it: the caller is told how long to wait until its share has refilled,
+    which works the same for threads (time.sleep) and coroutines (asyncio.sleep).
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Function to take `amount` units from the bucket
+
+        OUTPUT:
+            - seconds to wait before using them
+        """
+        with self.lock:
+            self._refill()
+            self.available -= amount
+            return max(0.0, -self.available / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """
+        Function to charge (positive) or refund (negative) units once the real usage is known
+        """
+        with self.lock:
+            self._refill()
+            self.available = min(self.capacity, self.available - amount)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets shared by every request of a client,
+    plus a pause honouring the server's Retry-After.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float | None = None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens: int = 0) -> float:
+        """
+        Function to reserve one request using about `tokens` tokens
+
+        OUTPUT:
+            - seconds to wait before sending it
+        """
+        wait = self.requests.reserve(1)
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self.lock:
+            return max(wait, self.blocked_until - time.monotonic())
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        Function to block the calling thread until a request of about `tokens` tokens may be sent
+        """
+        time.sleep(self.reserve(tokens))
+
+    def settle(self, estimated_tokens: int, used_tokens: int) -> None:
+        """
+        Function to correct the token budget with the usage reported by the server
+        """
+        if self.tokens is not None:
+            self.tokens.adjust(used_tokens - estimated_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Function to hold back every request for `seconds` (e.g. after a 429)
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def retry_after_seconds(header: str | None, default: float) -> float:
+    """
+    Function to read a Retry-After header (seconds or HTTP date), `default` when missing or unreadable
+    """
+    if not header:
+        return default
+    try:
+        return max(0.0, float(header))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+from datetime import datetime
+from .cache import content_hash
+
+LEDGER_PATH = "run-ledger.sqlite"
+# Backends whose prompt hashes are (output path, prompt text), see adopt_outputs
+ADOPTABLE_BACKENDS = ("local", "openrouter")
+
+
+def open_ledger(ledger_path: str = LEDGER_PATH) -> sqlite3.Connection:
+    """
+    Function to open (or create) the append-only ledger of finished inference calls
+
+    A row is added once an output has been written completely, so an interrupted run resumes from the
+    ledger and never from half written files. WAL mode lets several runners/workers append at once.
+    """
+    connection = sqlite3.connect(ledger_path, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS runs (
+            backend TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            params_hash TEXT NOT NULL,
+            params TEXT NOT NULL,
+            output_path TEXT NOT NULL,
+            finished_at TEXT NOT NULL,
+            PRIMARY KEY (backend, model, prompt_hash, params_hash)
+        )
+        """
+    )
+    return connection
+
+
+def params_key(params: dict) -> str:
+    """
+    Function to hash the parameters that change what an output means (mode, prompt type...)
+    """
+    return content_hash(json.dumps(params, sort_keys=True, default=str))
+
+
+def prompt_key(output_path: str, *contents: str | bytes) -> str:
+    """
+    Function to hash a prompt together with where its answer goes
+    (two prompt files with the same text still get their own output)
+    """
+    return content_hash(os.path.normpath(output_path), *contents)
+
+
+def completed_prompts(
+    connection: sqlite3.Connection, backend: str, model: str, params: dict
+) -> set[str]:
+    """
+    Function to read the prompt hashes already answered by a model with the given parameters
+
+    OUTPUT:
+        - set of prompt hashes (see prompt_key)
+    """
+    return {
+        prompt_hash
+        for (prompt_hash,) in connection.execute(
+            "SELECT prompt_hash FROM runs WHERE backend = ? AND model = ? AND params_hash = ?",
+            (backend, model, params_key(params)),
+        )
+    }
+
+
+def record_completion(
+    connection: sqlite3.Connection,
+    backend: str,
+    model: str,
+    prompt_hash: str,
+    params: dict,
+    output_path: str,
+) -> None:
+    """
+    Function to append a finished call to the ledger (the first completion of a prompt is kept)
+    """
+    with connection:
+        connection.execute(
+            "INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                backend,
+                model,
+                prompt_hash,
+                params_key(params),
+                json.dumps(params, sort_keys=True, default=str),
+                os.path.normpath(output_path),
+                datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+
+
+def adopt_existing_outputs(
+    connection: sqlite3.Connection,
+    backend: str,
+    model: str,
+    params: dict,
+    outputs: dict[str, str],
+) -> set[str]:
+    """
+    Function to record the non-empty outputs of a run written before the ledger existed, so upgrading
+    does not request them again. Only output paths without any ledger row for the model and parameters
+    are adopted (a path answered through the ledger for an older prompt text is run again).
+
+    INPUT:
+        - outputs -> prompt hash (see prompt_key) to output path, for the prompts of the run
+    OUTPUT:
+        - set of the prompt hashes adopted
+    """
+    recorded_paths = {
+        output_path
+        for (output_path,) in connection.execute(
+            "SELECT output_path FROM runs WHERE backend = ? AND model = ? AND params_hash = ?",
+            (backend, model, params_key(params)),
+        )
+    }
+    adopted = set()
+    for prompt_hash, output_path in outputs.items():
+        if (
+            os.path.normpath(output_path) not in recorded_paths
+            and os.path.isfile(output_path)
+            and os.path.getsize(output_path) > 0
+        ):
+            record_completion(connection, backend, model, prompt_hash, params, output_path)
+            adopted.add(prompt_hash)
+    return adopted
+
+
+def write_output_atomic(output_path: str, text: str) -> None:
+    """
+    Function to write an output through a temporary file renamed into place,
+    so the output either holds the whole answer or does not exist
+    (a temporary ".<name>.tmp" file can be left behind by a killed process, readers skip dotfiles)
+    """
+    output_dir = os.path.dirname(output_path) or "."
+    os.makedirs(output_dir, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=output_dir, prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(file_descriptor, "w") as output_file:
+            output_file.write(text)
+            output_file.flush()
+            os.fsync(output_file.fileno())
+        os.replace(temporary_path, output_path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def adopt_outputs(
+    backend: str,
+    model: str,
+    prompt_type: int,
+    params: dict,
+    dataset_path: str | None = None,
+    ledger_path: str = LEDGER_PATH,
+) -> int:
+    """
+    Function to record outputs written before the ledger existed, so they are not requested again.
+    Only non-empty output files are adopted, and only for ADOPTABLE_BACKENDS (Gemini also hashes the
+    questions and the content of every request, which are not known here).
+
+    OUTPUT:
+        - number of outputs adopted
+    """
+    from . import utils
+    from .prompt_generation import pattern_element_map
+
+    if backend not in ADOPTABLE_BACKENDS:
+        raise ValueError(
+            f"Cannot adopt {backend} outputs, only {', '.join(ADOPTABLE_BACKENDS)} are supported"
+        )
+    connection = open_ledger(ledger_path)
+    adopted = 0
+    for correct in (True, False):
+        for pattern in pattern_element_map:
+            try:
+                prompts = utils.load_prompts(prompt_type, correct, pattern, dataset_path)
+            except FileNotFoundError:
+                continue
+            for role, _, prompt_file_path, prompt_text in prompts:
+                output_path = utils.get_output_path(
+                    prompt_type, model, correct, pattern, role, prompt_file_path, params["mode"]
+                )
+                if os.path.isfile(output_path) and os.path.getsize(output_path) > 0:
+                    record_completion(
+                        connection,
+                        backend,
+                        model,
+                        prompt_key(output_path, prompt_text),
+                        params,
+                        output_path,
+                    )
+                    adopted += 1
+    connection.close()
+    return adopted
+
+
+def main():
+    if len(sys.argv) < 5 or sys.argv[1] != "adopt":
+        print(
+            "Usage: python -m src.run_ledger adopt <backend> <model> <prompt type> [params json]"
+        )
+        sys.exit(1)
+
+    backend, model, prompt_type = sys.argv[2], sys.argv[3], int(sys.argv[4])
+    if backend not in ADOPTABLE_BACKENDS:
+        print(f"Only {', '.join(ADOPTABLE_BACKENDS)} outputs can be adopted")
+        sys.exit(1)
+    params = json.loads(sys.argv[5]) if len(sys.argv) > 5 else {}
+    params = {"prompt_type": prompt_type, "mode": "generate", **params}
+    print(
+        f"Adopted {adopt_outputs(backend, model, prompt_type, params)} existing outputs "
+        f"of {model} ({backend}, {params})"
+    )
+
+
+if __name__ == "__main__":
+    main()
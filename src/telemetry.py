@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import resource
+from datetime import datetime
+import pandas as pd
+
+TELEMETRY_PATH = "telemetry.jsonl"
+
+
+def peak_rss_mb() -> float:
+    """
+    Function to read the peak resident memory of the current process in MB
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak_rss / 1024**2 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def record(backend: str, model: str, telemetry_path: str = TELEMETRY_PATH, **fields) -> None:
+    """
+    Function to append one inference record to the telemetry file (one JSON object per line)
+
+    INPUT:
+        - backend -> "local", "openrouter" or "gemini"
+        - model -> Model the request went to
+        - telemetry_path -> JSONL file to append to
+        - fields -> Anything else describing the call (pattern, prompt, token counts, timings, params...)
+    """
+    entry = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "backend": backend,
+        "model": model,
+        "pid": os.getpid(),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        **fields,
+    }
+    # A single write per line so parallel workers do not interleave records
+    with open(telemetry_path, "a") as telemetry_file:
+        telemetry_file.write(json.dumps(entry, default=str) + "\n")
+
+
+def load_telemetry(telemetry_path: str = TELEMETRY_PATH) -> pd.DataFrame:
+    """
+    Function to read the telemetry file into a DataFrame (one row per inference call)
+    """
+    with open(telemetry_path, "r") as telemetry_file:
+        return pd.DataFrame(
+            [json.loads(line) for line in telemetry_file if line.strip()]
+        )
+
+
+def summarize_telemetry(telemetry_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Function to aggregate telemetry by backend, model and pattern
+
+    OUTPUT:
+        - DataFrame with the number of calls, response cache hits, token totals, mean timings,
+          generation speed and peak memory
+    """
+    for column in (
+        "pattern",
+        "prompt_tokens",
+        "completion_tokens",
+        "latency_s",
+        "prefill_s",
+        "decode_s",
+        "ttft_s",
+    ):
+        if column not in telemetry_df:
+            telemetry_df[column] = None
+    telemetry_df["pattern"] = telemetry_df["pattern"].fillna("-")
+    telemetry_df["cache_hit"] = (
+        telemetry_df["cache_hit"].fillna(False).astype(bool)
+        if "cache_hit" in telemetry_df
+        else False
+    )
+
+    summary = telemetry_df.groupby(["backend", "model", "pattern"]).agg(
+        calls=("latency_s", "size"),
+        cache_hits=("cache_hit", "sum"),
+        prompt_tokens=("prompt_tokens", "sum"),
+        completion_tokens=("completion_tokens", "sum"),
+        mean_latency_s=("latency_s", "mean"),
+        mean_prefill_s=("prefill_s", "mean"),
+        mean_decode_s=("decode_s", "mean"),
+        mean_ttft_s=("ttft_s", "mean"),
+        total_latency_s=("latency_s", "sum"),
+        peak_rss_mb=("peak_rss_mb", "max"),
+    )
+    summary["tokens_per_s"] = summary["completion_tokens"] / summary["total_latency_s"]
+    return summary.round(3)
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    telemetry_path = sys.argv[2] if len(sys.argv) > 2 else TELEMETRY_PATH
+
+    if command == "summary":
+        with pd.option_context("display.max_rows", None, "display.width", 250):
+            print(summarize_telemetry(load_telemetry(telemetry_path)))
+    else:
+        print("Usage: python -m src.telemetry summary [telemetry path]")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import os
+import time
+import logging
+import psutil
+
+MAX_TEMPERATURE = 85.0
+RESUME_TEMPERATURE = 75.0
+MAX_CPU_PERCENT = 90.0
+# Frequency throttling is opt-in: idle cores are often clocked well under their maximum, so any fixed
+# ratio would pause cool machines too. Set THROTTLE_MIN_FREQUENCY_RATIO (e.g. 0.6) to enable it
+MIN_FREQUENCY_RATIO = 0.0
+POLL_INTERVAL = 5.0
+MAX_WAIT = 600.0
+
+
+def read_cpu_state(
+    sample_interval: float | None = None, process: psutil.Process | None = None
+) -> dict[str, float | None]:
+    """
+    Function to read the current CPU temperature, frequency and load
+
+    INPUT:
+        - sample_interval -> Seconds over which the CPU utilisation is measured, None (default) to return
+          the utilisation since the previous call without blocking
+        - process -> Process whose own share is left out of the load (only other programs count)
+
+    OUTPUT:
+        - dict with "temperature" (hottest sensor, C), "frequency_ratio" (current / max frequency)
+          and "cpu_percent"; readings the platform does not expose are None
+    """
+    temperature = None
+    try:
+        sensors = psutil.sensors_temperatures()
+    except AttributeError:
+        sensors = {}
+    readings = [entry.current for entries in sensors.values() for entry in entries]
+    if readings:
+        temperature = max(readings)
+
+    frequency_ratio = None
+    try:
+        frequency = psutil.cpu_freq()
+    except (AttributeError, NotImplementedError, FileNotFoundError):
+        frequency = None
+    if frequency is not None and frequency.max:
+        frequency_ratio = frequency.current / frequency.max
+
+    cpu_percent = psutil.cpu_percent(interval=sample_interval)
+    if process is not None:
+        # Process utilisation is summed over cores, the system one is averaged
+        own_percent = process.cpu_percent(interval=sample_interval) / (psutil.cpu_count() or 1)
+        cpu_percent = max(0.0, cpu_percent - own_percent)
+
+    return {
+        "temperature": temperature,
+        "frequency_ratio": frequency_ratio,
+        "cpu_percent": cpu_percent,
+    }
+
+
+class Throttle:
+    """
+    Waits between inference calls only while the machine is hot, throttling or busy,
+    instead of sleeping a fixed amount after every call.
+
+    A wait starts when the hottest sensor reaches max_temperature (or the frequency ratio drops under
+    min_frequency_ratio, or other processes keep the CPU above max_cpu_percent) and lasts until the
+    temperature is back under resume_temperature. Waits are capped at max_wait seconds.
+
+    The CPU load is sampled without blocking (utilisation since the previous reading, this process left
+    out since its own inference fills that window), so a cool machine is not held up at all.
+    """
+
+    def __init__(
+        self,
+        fixed_sleep: float,
+        max_temperature: float = MAX_TEMPERATURE,
+        resume_temperature: float = RESUME_TEMPERATURE,
+        max_cpu_percent: float = MAX_CPU_PERCENT,
+        min_frequency_ratio: float = MIN_FREQUENCY_RATIO,
+        poll_interval: float = POLL_INTERVAL,
+        max_wait: float = MAX_WAIT,
+        logger: logging.Logger | None = None,
+    ):
+        self.fixed_sleep = fixed_sleep
+        self.max_temperature = max_temperature
+        self.resume_temperature = resume_temperature
+        self.max_cpu_percent = max_cpu_percent
+        self.min_frequency_ratio = min_frequency_ratio
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.calls = 0
+        self.waited = 0.0
+        self.process = psutil.Process()
+        # First non-blocking reading only starts the measurement window
+        read_cpu_state(process=self.process)
+
+    def is_hot(self, state: dict[str, float | None], resuming: bool = False) -> bool:
+        """
+        Function to decide whether the machine needs a pause given a reading of read_cpu_state
+        """
+        temperature_limit = self.resume_temperature if resuming else self.max_temperature
+        if state["temperature"] is not None and state["temperature"] >= temperature_limit:
+            return True
+        if (
+            state["frequency_ratio"] is not None
+            and state["frequency_ratio"] < self.min_frequency_ratio
+        ):
+            return True
+        return state["cpu_percent"] >= self.max_cpu_percent
+
+    def wait(self) -> float:
+        """
+        Function to pause until the machine has cooled down (returns immediately when it is not hot)
+
+        OUTPUT:
+            - seconds waited
+        """
+        self.calls += 1
+        start_time = time.perf_counter()
+        state = read_cpu_state(process=self.process)
+        resuming = False
+        while self.is_hot(state, resuming):
+            if time.perf_counter() - start_time >= self.max_wait:
+                self.logger.warning(
+                    f"Still hot after {self.max_wait:.0f}s ({state}), continuing anyway"
+                )
+                break
+            if not resuming:
+                print(f"Machine hot ({state}), cooling down...")
+                resuming = True
+            time.sleep(self.poll_interval)
+            state = read_cpu_state(process=self.process)
+
+        waited = time.perf_counter() - start_time
+        self.waited += waited
+        if resuming:
+            self.logger.info(f"Cooled down for {waited:.1f}s ({state})")
+        return waited
+
+    def report(self) -> None:
+        """
+        Function to log how much idle time was avoided compared to the fixed sleeps
+        """
+        fixed_total = self.calls * self.fixed_sleep
+        message = (
+            f"Throttle: {self.calls} pauses, waited {self.waited:.0f}s instead of "
+            f"{fixed_total:.0f}s ({fixed_total - self.waited:.0f}s of idle time avoided)"
+        )
+        print(message)
+        self.logger.info(message)
+
+
+def throttle_from_env(
+    fixed_sleep: float, logger: logging.Logger | None = None, **defaults: float
+) -> Throttle:
+    """
+    Function to build a Throttle whose thresholds can be overridden through THROTTLE_* variables
+    (THROTTLE_MAX_TEMPERATURE, THROTTLE_RESUME_TEMPERATURE, THROTTLE_MAX_CPU_PERCENT,
+    THROTTLE_MIN_FREQUENCY_RATIO, THROTTLE_POLL_INTERVAL, THROTTLE_MAX_WAIT), on top of the
+    caller's defaults
+    """
+    thresholds = dict(defaults)
+    for name in (
+        "max_temperature",
+        "resume_temperature",
+        "max_cpu_percent",
+        "min_frequency_ratio",
+        "poll_interval",
+        "max_wait",
+    ):
+        value = os.environ.get(f"THROTTLE_{name.upper()}")
+        if value is not None:
+            thresholds[name] = float(value)
+    return Throttle(fixed_sleep, logger=logger, **thresholds)
@@ -0,0 +1,255 @@
+import os
+import argparse
+import pandas as pd
+from llama_cpp import Llama
+from llama_cpp.llama_chat_format import format_chatml
+from . import utils
+from .cache import content_hash, open_cache
+from .prompt_generation import pattern_element_map
+
+PATTERNS = tuple(pattern_element_map.keys())
+TOKEN_CACHE_SIZE = 64 * 1024 * 1024
+CONTEXT_GRANULARITY = 1024
+MIN_BUCKET_PROMPTS = 8
+
+
+def load_tokenizer(model_id: str) -> Llama:
+    """
+    Function to load only the vocabulary of a model's GGUF file (no weights)
+    """
+    return Llama(
+        model_path=utils.get_model_path(model_id),
+        vocab_only=True,
+        verbose=False,
+    )
+
+
+def format_chat_prompt(prompt: str) -> str:
+    """
+    Function to build the exact text the chatml chat format sends to the model for a prompt
+    """
+    return format_chatml(
+        messages=[
+            {"role": "system", "content": utils.SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
+    ).prompt
+
+
+def count_prompt_tokens(tokenizer: Llama, model_id: str, prompts: list[str]) -> list[int]:
+    """
+    Function to count the tokens of chat formatted prompts, cached per (model, prompt hash)
+
+    INPUT:
+        - tokenizer -> vocab only model (see load_tokenizer)
+        - model_id -> Model the tokenizer belongs to (part of the cache key)
+        - prompts -> Prompt texts
+
+    OUTPUT:
+        - list of token counts (system message and chat template included)
+    """
+    token_cache = open_cache("token-counts", TOKEN_CACHE_SIZE)
+    model_key = content_hash(model_id, str(os.path.getsize(tokenizer.model_path)))
+
+    token_counts = []
+    for prompt in prompts:
+        cache_key = content_hash(model_key, prompt)
+        token_count = token_cache.get(cache_key)
+        if token_count is None:
+            token_count = len(
+                tokenizer.tokenize(
+                    format_chat_prompt(prompt).encode("utf-8"),
+                    add_bos=True,
+                    special=True,
+                )
+            )
+            token_cache.set(cache_key, token_count)
+        token_counts.append(token_count)
+
+    token_cache.close()
+    return token_counts
+
+
+def analyze_prompt_set(
+    model_id: str,
+    prompt_type: int,
+    patterns: tuple = PATTERNS,
+    correctness: tuple = (True, False),
+    tokenizer: Llama | None = None,
+    dataset_path: str | None = None,
+) -> pd.DataFrame:
+    """
+    Function to tokenize every prompt of a prompt set with the target model's tokenizer
+
+    INPUT:
+        - model_id -> Model whose tokenizer is used
+        - prompt_type -> Prompt set (0 = code, 1 = uml, 2 = summary)
+        - patterns -> Patterns to include
+        - correctness -> Which of the correct/incorrect datasets to include
+        - tokenizer -> Already loaded tokenizer (loaded from model_id when not provided)
+        - dataset_path -> Packed dataset to read the prompts from (prompt directories when None)
+
+    OUTPUT:
+        - DataFrame with one row per prompt (correctness, pattern, role, prompt, tokens)
+    """
+    tokenizer = tokenizer if tokenizer is not None else load_tokenizer(model_id)
+
+    rows = []
+    for correct in correctness:
+        for pattern in patterns:
+            try:
+                prompts = utils.load_prompts(
+                    prompt_type, correct, pattern, dataset_path
+                )
+            except FileNotFoundError:
+                continue
+            token_counts = count_prompt_tokens(
+                tokenizer, model_id, [prompt_text for _, _, _, prompt_text in prompts]
+            )
+            for (role, prompt, _, _), tokens in zip(prompts, token_counts):
+                rows.append(
+                    [
+                        "correct" if correct else "incorrect",
+                        pattern,
+                        role,
+                        prompt,
+                        tokens,
+                    ]
+                )
+
+    return pd.DataFrame(
+        rows, columns=["Correctness", "Pattern", "Role", "Prompt", "Tokens"]
+    )
+
+
+def summarize_token_counts(token_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Function to describe the token count distribution per pattern and role
+    """
+    return (
+        token_df.groupby(["Pattern", "Role"])["Tokens"]
+        .describe(percentiles=[0.5, 0.9, 0.99])
+        .astype({"count": int})
+    )
+
+
+def choose_context_size(
+    token_counts: list[int], max_tokens: int, n_ctx_max: int
+) -> tuple[int, list[int]]:
+    """
+    Function to choose the smallest context (rounded up to CONTEXT_GRANULARITY) that fits the prompts
+
+    INPUT:
+        - token_counts -> Prompt lengths in tokens
+        - max_tokens -> Tokens reserved for the generated answer
+        - n_ctx_max -> Largest context that may be allocated
+
+    OUTPUT:
+        - (context size, positions of the prompts that would overflow n_ctx_max)
+    """
+    overflowing = [
+        i
+        for i, token_count in enumerate(token_counts)
+        if token_count + max_tokens > n_ctx_max
+    ]
+    needed = max(
+        (
+            token_count + max_tokens
+            for token_count in token_counts
+            if token_count + max_tokens <= n_ctx_max
+        ),
+        default=max_tokens,
+    )
+    n_ctx = -(-needed // CONTEXT_GRANULARITY) * CONTEXT_GRANULARITY
+    return min(n_ctx, n_ctx_max), overflowing
+
+
+def bucket_by_context(
+    token_df: pd.DataFrame,
+    max_tokens: int,
+    n_ctx_max: int,
+    min_bucket_prompts: int = MIN_BUCKET_PROMPTS,
+) -> list[tuple[int, pd.DataFrame]]:
+    """
+    Function to group prompts by the context they need, smallest context first
+
+    Contexts double from CONTEXT_GRANULARITY up to n_ctx_max, so the model is rebuilt only a few times.
+    Buckets with fewer than min_bucket_prompts prompts are merged into the next bigger one, and prompts
+    overflowing n_ctx_max go to the last bucket (the runner skips them).
+
+    INPUT:
+        - token_df -> Prompts with their "Tokens" (see analyze_prompt_set)
+        - max_tokens -> Tokens reserved for the generated answer
+        - n_ctx_max -> Largest context that may be allocated
+        - min_bucket_prompts -> Smallest group worth its own context
+
+    OUTPUT:
+        - list of (context size, prompts of the bucket) in increasing context size
+    """
+
+    def bucket_context(token_count: int) -> int:
+        n_ctx = CONTEXT_GRANULARITY
+        while n_ctx < token_count + max_tokens and n_ctx < n_ctx_max:
+            n_ctx *= 2
+        return min(n_ctx, n_ctx_max)
+
+    contexts = token_df["Tokens"].map(bucket_context)
+    buckets = []
+    pending = token_df.iloc[0:0]
+    for n_ctx in sorted(contexts.unique()):
+        pending = pd.concat([pending, token_df[contexts == n_ctx]])
+        if len(pending) >= min_bucket_prompts or n_ctx == contexts.max():
+            buckets.append((int(n_ctx), pending))
+            pending = token_df.iloc[0:0]
+    return buckets
+
+
+def main():
+    # Create Parser
+    parser = argparse.ArgumentParser(
+        description="Report prompt lengths in tokens for a model"
+    )
+
+    # Arguments
+    parser.add_argument("--model", type=str, help="Model whose tokenizer is used")
+    parser.add_argument("--prompt", type=int, help="What prompts to use")
+    parser.add_argument(
+        "--pattern", type=str, nargs="+", default=list(PATTERNS), help="Patterns"
+    )
+    parser.add_argument(
+        "--max-tokens", type=int, default=1200, help="Tokens reserved for answers"
+    )
+    parser.add_argument(
+        "--n-ctx-max", type=int, default=32768, help="Largest context allowed"
+    )
+    parser.add_argument(
+        "--dataset", type=str, default=None, help="Packed prompt dataset to read"
+    )
+
+    args = parser.parse_args()
+
+    assert args.model, "Model name cannot be empty..."
+    assert (
+        isinstance(args.prompt, int) and 0 <= args.prompt and args.prompt <= 2
+    ), "Prompt type not valid..."
+
+    token_df = analyze_prompt_set(
+        args.model, args.prompt, tuple(args.pattern), dataset_path=args.dataset
+    )
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(summarize_token_counts(token_df))
+
+    n_ctx, overflowing = choose_context_size(
+        token_df["Tokens"].tolist(), args.max_tokens, args.n_ctx_max
+    )
+    print(f"\nSmallest context fitting all prompts: {n_ctx}")
+    for i in overflowing:
+        row = token_df.iloc[i]
+        print(
+            f"Overflow: {row['Correctness']}/{row['Pattern']}/{row['Role']}/{row['Prompt']} "
+            f"({row['Tokens']} tokens)"
+        )
+
+
+if __name__ == "__main__":
+    main()
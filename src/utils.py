@@ -1,9 +1,12 @@
 import os
 import sys
 import pandas as pd
-from time import sleep
 from llama_cpp import Llama
 from pathlib import Path
+from .prompt_dataset import load_prompts as load_packed_prompts, prompt_sort_key
+from .throttle import throttle_from_env
+
+SYSTEM_PROMPT = "You are a senior software engineer experienced in object-oriented design patterns."
 
 
 def check_path_existence(path: str) -> None:
@@ -14,31 +17,70 @@ def check_path_existence(path: str) -> None:
         os.makedirs(path)
 
 
-def check_collected_prompts(
-    model_name: str, correct: bool, prompt_type: int
-) -> list[str]:
+def get_output_path(
+    prompt_type: int,
+    model_name: str,
+    correct: bool,
+    pattern: str,
+    role: str,
+    prompt_file_path: str,
+    mode: str = "generate",
+) -> str:
     """
-    Function that does not allow requesting duplicate prompts
+    Function to build where the answer of a model to a prompt file is stored
+    (modes other than "generate", e.g. "structured" or "score", get their own "<model>-<mode>" directory,
+    so runs in different modes never overwrite each other)
     """
-    # Access the outputs already collected
-    output_file_path = os.path.join(
+    model_dir = model_name.replace(":free", "")
+    if mode != "generate":
+        model_dir = f"{model_dir}-{mode}"
+    return os.path.join(
         ["code-outputs", "uml-outputs", "summary-outputs"][prompt_type],
-        model_name.replace(":free", ""),
+        model_dir,
         "correct" if correct else "incorrect",
+        pattern,
+        role,
+        os.path.basename(prompt_file_path),
     )
 
-    collected_prompts = []
 
-    for root_path, dirs, files in os.walk(output_file_path):
-        if dirs == []:
-            for file in files:
-                collected_prompts.append(
-                    os.path.join(
-                        os.path.sep.join(root_path.split(os.path.sep)[4:]), file
-                    )
-                )
+def list_prompt_files(
+    prompt_type: int, correct: bool, pattern: str
+) -> list[tuple[str, str, str]]:
+    """
+    Function to list the prompt files of a pattern as (role, prompt filename, prompt filepath)
+    """
+    pattern_prompt_path = os.path.join(
+        ["prompts-code", "prompts-uml", "prompts-summary"][prompt_type],
+        "correct" if correct else "incorrect",
+        pattern,
+    )
+
+    prompt_files = []
+    for role in os.listdir(pattern_prompt_path):
+        role_path = os.path.join(pattern_prompt_path, role)
+        for prompt in sorted(os.listdir(role_path), key=prompt_sort_key):
+            prompt_files.append((role, prompt, os.path.join(role_path, prompt)))
+
+    return prompt_files
 
-    return collected_prompts
+
+def load_prompts(
+    prompt_type: int, correct: bool, pattern: str, dataset_path: str | None = None
+) -> list[tuple[str, str, str, str]]:
+    """
+    Function to load the prompts of a pattern as (role, prompt filename, prompt path, prompt text),
+    from the packed dataset when one is given, otherwise from the prompt directories
+    """
+    if dataset_path is not None:
+        return load_packed_prompts(dataset_path, prompt_type, correct, pattern)
+
+    prompts = []
+    for role, prompt, prompt_filepath in list_prompt_files(prompt_type, correct, pattern):
+        with open(prompt_filepath, "r") as prompt_file:
+            prompts.append((role, prompt, prompt_filepath, prompt_file.read()))
+
+    return prompts
 
 
 def find_file_in_subdir(parent_dir: str, extension: str = ".gguf"):
@@ -61,18 +103,28 @@ def find_file_in_subdir(parent_dir: str, extension: str = ".gguf"):
     return str(files[0])
 
 
-def evaluate_files(model_id: str, prompt_type: int):
+def get_model_path(model_id: str) -> str:
     """
-    Function to evaluate the output files
+    Find the GGUF file of a model downloaded into the models directory
+    """
+    model_snapshot_path = os.path.join(
+        "models",
+        "--".join(["models"] + model_id.split(os.path.sep)),
+        "snapshots",
+    )
+    return find_file_in_subdir(model_snapshot_path)
+
+
+def load_summariser_model() -> Llama:
+    """
+    Function to load the small model that turns free-form answers into a Y/N verdict
     """
-    assert 0 <= prompt_type and prompt_type <= 2, "Prompt type not valid"
-    # Initialise Summariser model to help evaluation
     summariser_model_snapshot_path = os.path.join(
         "models",
         "--".join(["models"] + "Qwen/Qwen2.5-3B-Instruct-GGUF".split(os.path.sep)),
         "snapshots",
     )
-    summariser_model = Llama(
+    return Llama(
         model_path=find_file_in_subdir(summariser_model_snapshot_path),
         chat_format="chatml",
         seed=42,
@@ -84,6 +136,15 @@ def evaluate_files(model_id: str, prompt_type: int):
         verbose=False,
     )
 
+
+def evaluate_files(model_id: str, prompt_type: int):
+    """
+    Function to evaluate the output files
+    """
+    assert 0 <= prompt_type and prompt_type <= 2, "Prompt type not valid"
+    # The summariser is only loaded for answers that do not start with a verdict
+    summariser_model = None
+
     model_output_path = os.path.join(
         ["code-outputs", "uml-outputs", "summary-outputs"][prompt_type],
         model_id,
@@ -94,6 +155,7 @@ def evaluate_files(model_id: str, prompt_type: int):
         sys.exit(1)
 
     total_df_dict: dict[str, dict[str, pd.DataFrame]] = {}
+    throttle = throttle_from_env(fixed_sleep=15)
 
     for dir in os.listdir(model_output_path):
         # Iterate all subdirectories in output path
@@ -112,7 +174,10 @@ def evaluate_files(model_id: str, prompt_type: int):
                 for model_response in os.listdir(role_path):
                     model_response_path = os.path.join(role_path, model_response)
                     print(model_response_path)
-                    if not os.path.isfile(model_response_path):
+                    # Dotfiles are temporary outputs left by interrupted writes
+                    if model_response.startswith(".") or not os.path.isfile(
+                        model_response_path
+                    ):
                         continue
                     response_row = [model_response]
 
@@ -124,6 +189,8 @@ def evaluate_files(model_id: str, prompt_type: int):
                         elif response.lower().startswith("n"):
                             response_row.append("N")
                         else:
+                            if summariser_model is None:
+                                summariser_model = load_summariser_model()
                             summariser_response = summariser_model.create_chat_completion(
                                 messages=[
                                     {
@@ -158,11 +225,13 @@ def evaluate_files(model_id: str, prompt_type: int):
                                     print("Please provide either Y/n as response...\n")
                                     human_response = input("Response: ")
 
-                            sleep(15)
+                            throttle.wait()
 
                     response_df.loc[len(response_df)] = response_row
                 total_df_dict[dir][pattern] = response_df
 
+    throttle.report()
+
     with pd.ExcelWriter(
         os.path.join(model_output_path, "responses.xlsx"), engine="xlsxwriter"
     ) as writer:
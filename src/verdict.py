@@ -0,0 +1,156 @@
+import os
+import json
+import numpy as np
+from .cache import CACHE_DIR, content_hash
+
+VERDICT_MAX_TOKENS = 200
+MAX_EXPLANATION_CHARS = 600
+
+# YES/NO first, then 1 to 3 sentences ("." inside identifiers like Foo.getInstance() is allowed)
+VERDICT_GRAMMAR = r"""
+root ::= verdict "\n" sentence (" " sentence){0,2}
+verdict ::= "YES" | "NO"
+sentence ::= [A-Za-z0-9`(] ([^.\n] | "." [^ \n]){0,200} "."
+"""
+
+VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "verdict": {"type": "string", "enum": ["YES", "NO"]},
+        "explanation": {
+            "type": "string",
+            "description": "2-3 short sentences explaining the verdict",
+            "maxLength": MAX_EXPLANATION_CHARS,
+        },
+    },
+    "required": ["verdict", "explanation"],
+    "additionalProperties": False,
+}
+
+
+def format_verdict(verdict: str, explanation: str) -> str:
+    """
+    Function to write a structured verdict the way free-form answers look (verdict first, then the explanation)
+    """
+    return f"{verdict}\n{explanation.strip()[:MAX_EXPLANATION_CHARS]}"
+
+
+def parse_verdict_json(content: str) -> str:
+    """
+    Function to turn a JSON structured answer into the stored answer format
+
+    INPUT:
+        - content -> message content returned for VERDICT_SCHEMA
+
+    OUTPUT:
+        - answer text (str), raises ValueError when the content does not follow the schema
+    """
+    try:
+        answer = json.loads(content)
+        verdict = answer["verdict"].strip().upper()
+        explanation = answer["explanation"]
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Answer does not follow the verdict schema: {e}") from e
+    if verdict not in ("YES", "NO"):
+        raise ValueError(f"Unknown verdict {verdict}")
+    return format_verdict(verdict, explanation)
+
+
+# First tokens of these spellings count towards the verdict when scoring log-probabilities
+VERDICT_VARIANTS = {
+    "YES": ("YES", "Yes", "yes", " YES", " Yes", " yes"),
+    "NO": ("NO", "No", "no", " NO", " No", " no"),
+}
+CALIBRATION_DIR = os.path.join(CACHE_DIR, "verdict-calibration")
+# One prompt in CALIBRATION_FOLDS is held out to fit the calibration and never written as an output
+CALIBRATION_FOLDS = 5
+
+
+def is_calibration_prompt(prompt_hash: str) -> bool:
+    """
+    Function to tell whether a prompt (see run_ledger.prompt_key) belongs to the held-out calibration split
+    """
+    return int(prompt_hash, 16) % CALIBRATION_FOLDS == 0
+
+
+def fit_platt_scaling(
+    log_odds: list[float], labels: list[bool], iterations: int = 50
+) -> dict[str, float]:
+    """
+    Function to fit P(YES) = sigmoid(scale * log_odds + bias) to labelled scores (Newton's method)
+
+    INPUT:
+        - log_odds -> log P(YES) - log P(NO) read from the model
+        - labels -> whether the pattern is really there (the correct dataset)
+        - iterations -> Newton steps
+
+    OUTPUT:
+        - calibration dict {"scale", "bias", "samples"}
+    """
+    x = np.asarray(log_odds, dtype=np.float64)
+    # Platt's smoothed targets keep the fit finite on separable data
+    positives = sum(labels)
+    negatives = len(labels) - positives
+    y = np.where(
+        np.asarray(labels), (positives + 1) / (positives + 2), 1 / (negatives + 2)
+    )
+    features = np.stack([x, np.ones_like(x)], axis=1)
+
+    def loss(weights: np.ndarray) -> float:
+        z = features @ weights
+        return float(np.sum(np.logaddexp(0, z) - y * z))
+
+    # Newton steps from the flat model, halved while they do not lower the loss
+    weights = np.zeros(2)
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-(features @ weights)))
+        gradient = features.T @ (p - y)
+        hessian = features.T @ (features * (p * (1 - p))[:, None]) + 1e-6 * np.eye(2)
+        step = np.linalg.solve(hessian, gradient)
+        while loss(weights - step) > loss(weights) and np.abs(step).max() > 1e-12:
+            step /= 2
+        weights -= step
+        if np.abs(step).max() < 1e-8:
+            break
+    return {"scale": float(weights[0]), "bias": float(weights[1]), "samples": len(labels)}
+
+
+def calibrated_confidence(log_odds: float, calibration: dict[str, float] | None) -> float:
+    """
+    Function to turn a verdict log-odds into P(YES), raw softmax probability when not calibrated
+    """
+    scale, bias = (
+        (calibration["scale"], calibration["bias"]) if calibration else (1.0, 0.0)
+    )
+    return float(1 / (1 + np.exp(-(scale * log_odds + bias))))
+
+
+def calibration_path(model_id: str, prompt_type: int) -> str:
+    """
+    Function to build where the calibration of a model on a prompt set is kept
+    """
+    return os.path.join(
+        CALIBRATION_DIR, f"{content_hash(model_id)[:16]}-{prompt_type}.json"
+    )
+
+
+def load_calibration(model_id: str, prompt_type: int) -> dict[str, float] | None:
+    """
+    Function to read a stored calibration (None when the model was never calibrated)
+    """
+    try:
+        with open(calibration_path(model_id, prompt_type), "r") as calibration_file:
+            return json.load(calibration_file)
+    except FileNotFoundError:
+        return None
+
+
+def save_calibration(
+    model_id: str, prompt_type: int, calibration: dict[str, float]
+) -> None:
+    """
+    Function to store the calibration of a model on a prompt set
+    """
+    os.makedirs(CALIBRATION_DIR, exist_ok=True)
+    with open(calibration_path(model_id, prompt_type), "w") as calibration_file:
+        json.dump({"model": model_id, **calibration}, calibration_file, indent=4)